@@ -0,0 +1,4 @@
+# -*- coding: utf-8 -*-
+__doc__ = """Benchmarks for elib package.
+Run from repository root, for example:
+    python3 -m benchmarks.parser"""
@@ -0,0 +1,186 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import os
+import sys
+import json
+import base64
+import random
+import zipfile
+from xml.sax.saxutils import escape
+
+__doc__ = """Generator of synthetic library: fb2, fb2.zip and epub books.
+Same arguments and seed give same library.
+
+Example:
+    python3 -m benchmarks.library /tmp/library --books 10000 --binaries 2"""
+
+FORMATS = ('fb2', 'fb2.zip', 'epub')
+# Files in one directory
+DIRSIZE = 100
+
+FB2 = """<?xml version="1.0" encoding="utf-8"?>
+<FictionBook xmlns="http://www.gribuser.ru/xml/fictionbook/2.0"
+             xmlns:l="http://www.w3.org/1999/xlink">
+<description><title-info>{genres}{authors}
+<book-title>{title}</book-title><lang>{lang}</lang></title-info></description>
+<body>{body}</body>
+{binaries}
+</FictionBook>"""
+FB2AUTHOR = ("<author><first-name>{}</first-name>"
+             "<last-name>{}</last-name></author>")
+
+CONTAINER = """<?xml version="1.0"?>
+<container version="1.0"
+           xmlns="urn:oasis:names:tc:opendocument:xmlns:container">
+<rootfiles><rootfile full-path="OEBPS/content.opf"
+ media-type="application/oebps-package+xml"/></rootfiles></container>"""
+OPF = """<?xml version="1.0"?>
+<package xmlns="http://www.idpf.org/2007/opf" version="2.0"
+         xmlns:dc="http://purl.org/dc/elements/1.1/">
+<metadata><dc:title>{title}</dc:title><dc:creator>{author}</dc:creator>
+<dc:language>{lang}</dc:language>{subjects}</metadata></package>"""
+
+SYLLABLES = ('ка', 'ро', 'ми', 'на', 'ле', 'ва', 'то', 'се', 'по', 'ди',
+             'ga', 're', 'lo', 'ti', 'mun', 'der', 'son', 'ber', 'al', 'vin')
+LANGS = ('ru', 'ru', 'ru', 'en', 'uk')
+
+def word(rnd, parts=3):
+    return "".join(rnd.choice(SYLLABLES) for _ in range(parts)).capitalize()
+
+def randbytes(rnd, size):
+    return rnd.getrandbits(8 * size).to_bytes(size, 'little')
+
+class Library:
+    """Description of library, books are written by generate.
+    books - number of books;
+    authors, genres - sizes of pools of names;
+    binaries - number of images in fb2 books (also added to epub);
+    binarysize - size of image in KiB;
+    paragraphs - text paragraphs in book."""
+    def __init__(self, books=1000, authors=200, genres=30, binaries=0,
+                 binarysize=16, paragraphs=50, formats=FORMATS, seed=0):
+        for fmt in formats:
+            if fmt not in FORMATS:
+                raise ValueError("Unknown format: {}".format(fmt))
+        self.books = books
+        self.binaries = binaries
+        self.binarysize = binarysize
+        self.paragraphs = paragraphs
+        self.formats = formats
+        self.rnd = random.Random(seed)
+        rnd = self.rnd
+        self.authors = sorted(set((word(rnd, 2), word(rnd))
+                                  for _ in range(authors)))
+        self.genres = sorted(set(word(rnd, 2).lower()
+                                 for _ in range(genres)))
+
+    def book(self, i):
+        """Metadata of book number i."""
+        rnd = self.rnd
+        return {"title": "{} {}".format(word(rnd), i),
+                "lang": rnd.choice(LANGS),
+                "authors": rnd.sample(self.authors,
+                                      min(len(self.authors),
+                                          rnd.choice((1, 1, 1, 2, 3)))),
+                "genres": rnd.sample(self.genres,
+                                     min(len(self.genres),
+                                         rnd.choice((1, 2)))),
+                }
+
+    def fb2(self, info):
+        rnd = self.rnd
+        body = "".join("<section><p>{}</p></section>".format(
+                            " ".join(word(rnd, 2) for _ in range(40)))
+                       for _ in range(self.paragraphs))
+        binaries = "".join(
+            '<binary id="i{}.jpg" content-type="image/jpeg">{}</binary>'.\
+                format(n, base64.b64encode(
+                    randbytes(rnd, self.binarysize * 1024)).decode())
+            for n in range(self.binaries))
+        return FB2.format(
+            genres="".join("<genre>{}</genre>".format(g)
+                           for g in info["genres"]),
+            authors="".join(FB2AUTHOR.format(escape(f), escape(l))
+                            for f, l in info["authors"]),
+            title=escape(info["title"]), lang=info["lang"],
+            body=body, binaries=binaries).encode("utf-8")
+
+    def epub(self, filename, info):
+        firstname, lastname = info["authors"][0]
+        opf = OPF.format(title=escape(info["title"]),
+                         author=escape("{} {}".format(firstname, lastname)),
+                         lang=info["lang"],
+                         subjects="".join(
+                            "<dc:subject>{}</dc:subject>".format(g)
+                            for g in info["genres"]))
+        with zipfile.ZipFile(filename, 'w', zipfile.ZIP_DEFLATED) as z:
+            z.writestr(zipfile.ZipInfo('mimetype'), 'application/epub+zip')
+            z.writestr('META-INF/container.xml', CONTAINER)
+            z.writestr('OEBPS/content.opf', opf)
+            z.writestr('OEBPS/text.html', "<html><body>{}</body></html>".\
+                        format(" ".join(word(self.rnd, 2) for _ in
+                                        range(40 * self.paragraphs))))
+            for n in range(self.binaries):
+                z.writestr('OEBPS/i{}.jpg'.format(n),
+                           randbytes(self.rnd, self.binarysize * 1024))
+
+    def generate(self, path):
+        """Write books to path. Return statistics of library."""
+        stats = {"books": 0, "bytes": 0,
+                 "authors": len(self.authors), "genres": len(self.genres)}
+        for fmt in self.formats:
+            stats[fmt] = 0
+        for i in range(self.books):
+            fmt = self.formats[i % len(self.formats)]
+            directory = os.path.join(path, "d{:04d}".format(i // DIRSIZE))
+            os.makedirs(directory, exist_ok=True)
+            name = "book{:06d}".format(i)
+            filename = os.path.join(directory, "{}.{}".format(name, fmt))
+            info = self.book(i)
+            if fmt == 'fb2':
+                with open(filename, 'wb') as f:
+                    f.write(self.fb2(info))
+            elif fmt == 'fb2.zip':
+                with zipfile.ZipFile(filename, 'w',
+                                     zipfile.ZIP_DEFLATED) as z:
+                    z.writestr(name + '.fb2', self.fb2(info))
+            else:
+                self.epub(filename, info)
+            stats["books"] += 1
+            stats[fmt] += 1
+            stats["bytes"] += os.path.getsize(filename)
+        return stats
+
+def generate(path, **kwargs):
+    """Write synthetic library to path, see Library for arguments.
+    Return statistics of library."""
+    return Library(**kwargs).generate(path)
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument("path", help="directory for library")
+    parser.add_argument("--books", type=int, default=1000,
+                        help="number of books")
+    parser.add_argument("--authors", type=int, default=200,
+                        help="number of different authors")
+    parser.add_argument("--genres", type=int, default=30,
+                        help="number of different genres")
+    parser.add_argument("--binaries", type=int, default=0,
+                        help="number of images in every book")
+    parser.add_argument("--binarysize", type=int, default=16,
+                        help="size of every image in KiB")
+    parser.add_argument("--formats", default=",".join(FORMATS),
+                        help="comma separated formats: fb2,fb2.zip,epub")
+    parser.add_argument("--seed", type=int, default=0,
+                        help="seed of random generator")
+    args = parser.parse_args()
+    stats = generate(args.path, books=args.books, authors=args.authors,
+                     genres=args.genres, binaries=args.binaries,
+                     binarysize=args.binarysize,
+                     formats=tuple(args.formats.split(",")), seed=args.seed)
+    json.dump(stats, sys.stdout, indent=2)
+    print()
+
+if __name__ == '__main__':
+    main()
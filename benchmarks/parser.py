@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import os
+import sys
+import json
+import time
+import base64
+import resource
+import tempfile
+import multiprocessing
+from lxml import etree
+from elib.crawler import parsebooks
+
+__doc__ = """Compare full-document fb2 parsing with header-only parser.
+
+Example:
+    python3 -m benchmarks.parser --binary 4096 --repeat 50"""
+
+FB2 = """<?xml version="1.0" encoding="utf-8"?>
+<FictionBook xmlns="http://www.gribuser.ru/xml/fictionbook/2.0"
+             xmlns:l="http://www.w3.org/1999/xlink">
+<description><title-info><genre>sf</genre>
+<author><first-name>Arkady</first-name><last-name>Strugatsky</last-name></author>
+<book-title>Benchmark</book-title><lang>ru</lang></title-info></description>
+<body>{body}</body>
+{binaries}
+</FictionBook>"""
+
+def makebook(filename, binary=1024, images=4, paragraphs=2000):
+    """Write illustrated fb2 book.
+    binary - size of every image in KiB."""
+    body = "<section><p>Text of paragraph.</p></section>" * paragraphs
+    head, tail = FB2.format(body=body, binaries="{}").split("{}")
+    with open(filename, 'w') as f:
+        f.write(head)
+        for i in range(images):
+            f.write('<binary id="i{}.jpg" content-type="image/jpeg">'.\
+                    format(i))
+            # Written by parts, so generator does not grow peak RSS
+            for j in range(binary):
+                f.write(base64.b64encode(os.urandom(1023)).decode())
+            f.write('</binary>')
+        f.write(tail)
+
+def resetpeak():
+    """Reset peak RSS of current process if kernel supports it."""
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        pass
+
+def peakrss():
+    """Peak RSS of current process in KiB."""
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+def fullparse(filename):
+    """Parse whole document like crawler did before header-only parser."""
+    ns = {'n': 'http://www.gribuser.ru/xml/fictionbook/2.0'}
+    tree = etree.parse(filename)
+    title = tree.xpath('//n:book-title', namespaces=ns)[0].text
+    genres = [e.text for e in tree.xpath('//n:genre', namespaces=ns)]
+    lang = tree.xpath('//n:title-info/n:lang', namespaces=ns)[0].text
+    authors = tree.xpath('//n:title-info/n:author', namespaces=ns)
+    return title, genres, lang, authors
+
+def headerparse(filename):
+    return parsebooks(filename)
+
+PARSERS = {"full": fullparse, "header": headerparse}
+
+def measure(name, filename, repeat, queue):
+    """Run in child process: time and peak memory of one parser."""
+    foo = PARSERS[name]
+    try:
+        # Warm up: one-time initialisation is not measured
+        foo(filename)
+    except Exception as e:
+        queue.put({"parser": name, "error": str(e)})
+        return
+    resetpeak()
+    before = peakrss()
+    times = []
+    for i in range(repeat):
+        start = time.perf_counter()
+        foo(filename)
+        times.append(time.perf_counter() - start)
+    after = peakrss()
+    times.sort()
+    queue.put({"parser": name,
+               "mean_ms": 1000 * sum(times) / len(times),
+               "median_ms": 1000 * times[len(times) // 2],
+               "peak_rss_delta_kib": after - before,
+               })
+
+def run(binary=1024, images=4, repeat=20):
+    """Return list of results for every parser."""
+    results = []
+    with tempfile.TemporaryDirectory() as tmp:
+        filename = os.path.join(tmp, "book.fb2")
+        makebook(filename, binary, images)
+        size = os.path.getsize(filename)
+        # Fresh interpreter for every parser, so peak RSS
+        # is not shared between them.
+        context = multiprocessing.get_context("spawn")
+        queue = context.Queue()
+        for name in sorted(PARSERS):
+            p = context.Process(target=measure,
+                                        args=(name, filename, repeat, queue))
+            p.start()
+            result = queue.get()
+            p.join()
+            result["file_size"] = size
+            results.append(result)
+    return results
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--binary", type=int, default=1024,
+                        help="size of every image in KiB")
+    parser.add_argument("--images", type=int, default=4,
+                        help="number of images in book")
+    parser.add_argument("--repeat", type=int, default=20,
+                        help="number of parses per parser")
+    args = parser.parse_args()
+    results = run(args.binary, args.images, args.repeat)
+    json.dump(results, sys.stdout, indent=2)
+    print()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import os
+import sys
+import json
+import time
+import tempfile
+import statistics
+import subprocess
+
+__doc__ = """Measure startup of elib: import time of modules
+(python -X importtime) and wall time of commands, which
+do not use database.
+
+Example:
+    python3 -m benchmarks.startup --repeat 20"""
+
+MODULES = ('elib.elib', 'elib.zipper', 'elib.counterman', 'elib.crawler')
+# Imports which commands without database must not pay for
+HEAVY = ('sqlalchemy', 'lxml')
+COMMANDS = {'help': ['-h'],
+            'zip': ['-z', '-q', '-p', '{empty}'],
+            'test': ['-t', '-q', '-p', '{empty}'],
+            }
+
+def environment(home):
+    """Environment of child: repository in path,
+    config in temporary home."""
+    env = dict(os.environ)
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env["PYTHONPATH"] = os.pathsep.join(
+                    filter(None, [root, env.get("PYTHONPATH")]))
+    env["HOME"] = home
+    return env
+
+def importtime(module, env):
+    """Return result for import of module in fresh interpreter."""
+    p = subprocess.run([sys.executable, "-X", "importtime",
+                        "-c", "import {}".format(module)],
+                       env=env, stderr=subprocess.PIPE,
+                       universal_newlines=True, check=True)
+    top = []
+    names = set()
+    for line in p.stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        if not cumulative.strip().isdigit():
+            # Header line
+            continue
+        names.add(name.strip().split(".")[0])
+        if not name.startswith("  "):
+            top.append((int(cumulative), name.strip()))
+    top.sort(reverse=True)
+    return {"module": module,
+            "import_us": sum(us for us, name in top),
+            "heaviest": [{"name": name, "cumulative_us": us}
+                         for us, name in top[:5]],
+            "heavy_imported": [name for name in HEAVY if name in names],
+            }
+
+def command(name, args, env, repeat):
+    """Return result for repeated runs of elib command."""
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, "-m", "elib.elib"] + args,
+                       env=env, stdout=subprocess.DEVNULL, check=True)
+        times.append(time.perf_counter() - start)
+    return {"command": name,
+            "args": args,
+            "repeat": repeat,
+            "median_ms": statistics.median(times) * 1000,
+            "min_ms": min(times) * 1000,
+            }
+
+def run(repeat=10):
+    """Return list of results for modules and commands."""
+    results = []
+    with tempfile.TemporaryDirectory() as tmp:
+        home = os.path.join(tmp, "home")
+        empty = os.path.join(tmp, "empty")
+        os.makedirs(os.path.join(home, ".elib"))
+        os.mkdir(empty)
+        env = environment(home)
+        for module in MODULES:
+            results.append(importtime(module, env))
+        for name in sorted(COMMANDS):
+            args = [arg.format(empty=empty) for arg in COMMANDS[name]]
+            results.append(command(name, args, env, repeat))
+    return results
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--repeat", type=int, default=10,
+                        help="number of runs per command")
+    args = parser.parse_args()
+    results = run(args.repeat)
+    json.dump(results, sys.stdout, indent=2)
+    print()
+
+if __name__ == '__main__':
+    main()
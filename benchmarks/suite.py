@@ -0,0 +1,242 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import os
+import sys
+import json
+import time
+import shutil
+import tempfile
+import multiprocessing
+from benchmarks.library import generate
+from benchmarks.parser import resetpeak, peakrss
+
+__doc__ = """Benchmarks of crawler, zipper and Counterman getters
+on synthetic library and temporary SQLite database.
+Every benchmark runs in fresh process, results are printed as JSON.
+
+Example:
+    python3 -m benchmarks.suite --books 2000 --repeat 20 > before.json"""
+
+def percentile(values, p):
+    """Nearest-rank percentile of sorted values."""
+    if not values:
+        return None
+    k = max(0, min(len(values) - 1, int(round(p / 100 * len(values))) - 1))
+    return values[k]
+
+def result(name, latencies, seconds, size=None):
+    """Summary of benchmark: latencies in seconds of every item,
+    seconds - total time, size - processed bytes."""
+    latencies = sorted(latencies)
+    items = len(latencies)
+    r = {"benchmark": name,
+         "items": items,
+         "seconds": seconds,
+         "items_per_s": items / seconds if seconds else None,
+         "latency_ms": {"p50": 1000 * percentile(latencies, 50),
+                        "p90": 1000 * percentile(latencies, 90),
+                        "p99": 1000 * percentile(latencies, 99),
+                        "max": 1000 * latencies[-1]} if items else None,
+         }
+    if size is not None:
+        r["mb_per_s"] = size / seconds / 2**20 if seconds else None
+    return r
+
+def librarysize(path):
+    total = 0
+    for base, dirs, files in os.walk(path):
+        for name in files:
+            total += os.path.getsize(os.path.join(base, name))
+    return total
+
+def bench_walk(options):
+    """Crawler.walk: parse every file, books are not saved."""
+    from elib.crawler import Crawler
+    latencies = []
+    class Timed(Crawler):
+        def handlerecord(self, filename, records, error):
+            now = time.perf_counter()
+            latencies.append(now - self.last)
+            self.last = now
+    crawler = Timed(options["library"], jobs=options["jobs"])
+    start = crawler.last = time.perf_counter()
+    crawler.walk()
+    return result("crawler.walk", latencies, time.perf_counter() - start,
+                  librarysize(options["library"]))
+
+def bench_index(options):
+    """CrawlerManager.run: parse and save to new database."""
+    from elib.manager import BookManager
+    from elib.crawler import CrawlerManager
+    latencies = []
+    class Timed(CrawlerManager):
+        def handlerecord(self, filename, records, error):
+            super().handlerecord(filename, records, error)
+            now = time.perf_counter()
+            latencies.append(now - self.last)
+            self.last = now
+    manager = BookManager(options["command"])
+    crawler = Timed(manager, jobs=options["jobs"])
+    start = crawler.last = time.perf_counter()
+    crawler.run(options["library"])
+    return result("crawler.index", latencies, time.perf_counter() - start,
+                  librarysize(options["library"]))
+
+LATENCIES = []
+
+def timedjob(filename, removeoriginal, job):
+    start = time.perf_counter()
+    try:
+        return job(filename, removeoriginal)
+    finally:
+        LATENCIES.append(time.perf_counter() - start)
+
+def zipperjob(name, job, path):
+    """Run zipper job like zippath and testpath do, timing every file."""
+    from functools import partial
+    from elib import zipper
+    del LATENCIES[:]
+    size = librarysize(path)
+    start = time.perf_counter()
+    zipper.runjobs(partial(timedjob, job=job), path)
+    return result(name, LATENCIES, time.perf_counter() - start, size)
+
+def bench_zippath(options):
+    """zipper.zippath on copy of library."""
+    from elib import zipper
+    return zipperjob("zipper.zippath", zipper.zipjob, options["zipcopy"])
+
+def bench_testpath(options):
+    """zipper.testpath on library, without test cache."""
+    from elib import zipper
+    return zipperjob("zipper.testpath", zipper.testjob, options["library"])
+
+def getterargs(session):
+    """Arguments of Counterman getters, taken from indexed database."""
+    from elib.models import Book, Author, Genre
+    book = session.query(Book).order_by(Book.id).first()
+    author = session.query(Author).order_by(Author.id).first()
+    genre = session.query(Genre).order_by(Genre.id).first()
+    word = book.title.split()[0]
+    return {"get_author_by_id": (author.id,),
+            "get_authors_by_name": (author.lastname,),
+            "get_authors_by_similar_name": (author.lastname,),
+            "get_genre_by_name": (genre.name,),
+            "get_genre_by_id": (genre.id,),
+            "get_book_by_id": (book.id,),
+            "get_books_by_title": (book.title,),
+            "get_books_by_lang": (book.lang,),
+            "get_books_by_author_id": (author.id,),
+            "get_books_by_genre": (genre.name,),
+            "get_book_by_path": (book.path,),
+            "get_books_by_words": (word,),
+            "search": (word,),
+            }
+
+def bench_getter(options):
+    """One Counterman getter, called repeat times."""
+    from elib.manager import BookManager
+    from elib.counterman import Counterman
+    name = options["getter"]
+    manager = BookManager(options["command"])
+    c = Counterman(manager)
+    args = getterargs(manager.getsession()).get(name, ())
+    foo = getattr(c, name)
+    latencies = []
+    start = time.perf_counter()
+    for _ in range(options["repeat"]):
+        t = time.perf_counter()
+        foo(*args)
+        latencies.append(time.perf_counter() - t)
+        # Every call loads objects again
+        manager.getsession().expunge_all()
+    return result("counterman." + name, latencies,
+                  time.perf_counter() - start)
+
+BENCHMARKS = {"walk": bench_walk, "index": bench_index,
+              "zippath": bench_zippath, "testpath": bench_testpath,
+              "getter": bench_getter}
+
+def measure(kind, options, queue):
+    """Run in child process: benchmark and its peak memory."""
+    resetpeak()
+    try:
+        r = BENCHMARKS[kind](options)
+    except Exception as e:
+        r = {"benchmark": options.get("getter", kind), "error": repr(e)}
+    r["peak_rss_kib"] = peakrss()
+    queue.put(r)
+
+def getters():
+    from elib.counterman import Counterman
+    return sorted(name for name in dir(Counterman)
+                  if name.startswith("get_") or name == "search")
+
+def run(books=1000, authors=200, genres=30, binaries=0, binarysize=16,
+        jobs=1, repeat=20, seed=0, only=None):
+    """Return dictionary with library statistics and list of results.
+    only - names of benchmarks to run (walk, index, zippath,
+    testpath, getters), by default all."""
+    results = []
+    with tempfile.TemporaryDirectory() as tmp:
+        library = os.path.join(tmp, "library")
+        stats = generate(library, books=books, authors=authors,
+                         genres=genres, binaries=binaries,
+                         binarysize=binarysize, seed=seed)
+        zipcopy = os.path.join(tmp, "zipcopy")
+        shutil.copytree(library, zipcopy)
+        options = {"library": library, "zipcopy": zipcopy,
+                   "command": "sqlite:///{}".format(
+                                os.path.join(tmp, "elib.db")),
+                   "jobs": jobs, "repeat": repeat}
+        tasks = [(kind, options) for kind in
+                 ("walk", "index", "zippath", "testpath")]
+        # Getters use database filled by index
+        tasks += [("getter", dict(options, getter=name))
+                  for name in getters()]
+        context = multiprocessing.get_context("spawn")
+        queue = context.Queue()
+        for kind, opts in tasks:
+            group = "getters" if kind == "getter" else kind
+            if only and group not in only and "index" != kind:
+                continue
+            p = context.Process(target=measure, args=(kind, opts, queue))
+            p.start()
+            r = queue.get()
+            p.join()
+            if not only or group in only:
+                results.append(r)
+    return {"library": stats, "jobs": jobs, "results": results}
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--books", type=int, default=1000,
+                        help="number of books in library")
+    parser.add_argument("--authors", type=int, default=200,
+                        help="number of different authors")
+    parser.add_argument("--genres", type=int, default=30,
+                        help="number of different genres")
+    parser.add_argument("--binaries", type=int, default=0,
+                        help="number of images in every book")
+    parser.add_argument("--binarysize", type=int, default=16,
+                        help="size of every image in KiB")
+    parser.add_argument("-j", "--jobs", type=int, default=1,
+                        help="worker processes for crawler")
+    parser.add_argument("--repeat", type=int, default=20,
+                        help="number of calls of every getter")
+    parser.add_argument("--seed", type=int, default=0,
+                        help="seed of library generator")
+    parser.add_argument("--only", nargs="+",
+                        choices=("walk", "index", "zippath",
+                                 "testpath", "getters"),
+                        help="run only these benchmarks")
+    args = parser.parse_args()
+    results = run(args.books, args.authors, args.genres, args.binaries,
+                  args.binarysize, args.jobs, args.repeat, args.seed,
+                  args.only)
+    json.dump(results, sys.stdout, indent=2)
+    print()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import time
+import weakref
+import threading
+from collections import OrderedDict
+from functools import wraps
+
+__doc__ = """Bounded LRU cache with time to live for query results.
+
+Example:
+    c = Counterman(manager, cache=QueryCache(256, ttl=300))
+    c.get_all_genres()
+    c.get_all_genres()  # from cache
+    print(c.cache.hits, c.cache.misses)"""
+
+class QueryCache:
+    """LRU cache of results.
+    maxsize - max number of results;
+    ttl - seconds while result is valid (None - until invalidated);
+    version - version of catalog results belong to."""
+    def __init__(self, maxsize=256, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.data = OrderedDict()
+        self.version = None
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.data)
+
+    def __repr__(self):
+        return "<QueryCache(size={}, hits={}, misses={})>".\
+                format(len(self.data), self.hits, self.misses)
+
+    def get(self, key):
+        """Return tuple (found, value)."""
+        with self.lock:
+            item = self.data.get(key)
+            if item is not None:
+                value, expire = item
+                if expire is None or expire > time.monotonic():
+                    self.data.move_to_end(key)
+                    self.hits += 1
+                    return True, value
+                del self.data[key]
+            self.misses += 1
+            return False, None
+
+    def put(self, key, value):
+        expire = None
+        if self.ttl is not None:
+            expire = time.monotonic() + self.ttl
+        with self.lock:
+            self.data[key] = (value, expire)
+            self.data.move_to_end(key)
+            while len(self.data) > self.maxsize:
+                self.data.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+
+    def check(self, version):
+        """Drop all results if catalog changed."""
+        with self.lock:
+            if self.version != version:
+                self.data.clear()
+                self.version = version
+
+
+def sessionkey(session):
+    """Part of key for results of session. Weak reference
+    to dead session is not equal to any other, so results
+    of finished thread are not found by new session
+    which got same id."""
+    return weakref.ref(session)
+
+
+def cached(method):
+    """Decorator for Counterman methods: result is saved
+    in self.cache by session, method name and arguments.
+    Results are objects of session of current thread, other
+    threads must not use them (lazy loads go through that
+    session), so every session has own results; session is
+    referenced weakly, cache does not keep it and its connection.
+    Cache is cleared when self.manager.version changes."""
+    @wraps(method)
+    def wrapper(self, *args, **kwargs):
+        cache = self.cache
+        if cache is None:
+            return method(self, *args, **kwargs)
+        cache.check(self.manager.version)
+        key = (sessionkey(self.session), method.__name__, args,
+               tuple(sorted(kwargs.items())))
+        found, value = cache.get(key)
+        if not found:
+            value = method(self, *args, **kwargs)
+            cache.put(key, value)
+        return value
+    return wrapper
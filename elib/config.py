@@ -1,8 +1,23 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 import configparser
+import hashlib
 import os
 
+# Named SQLite storage profiles: PRAGMA -> value.
+# default - WAL with full sync, every commit is durable;
+# bulk - for initial indexing, last transactions may be lost
+# on power failure; safe - SQLite defaults.
+PROFILES = {
+    'safe': {},
+    'default': {'journal_mode': 'WAL', 'synchronous': 'FULL',
+                'cache_size': '-65536', 'mmap_size': '268435456',
+                'temp_store': 'MEMORY'},
+    'bulk': {'journal_mode': 'WAL', 'synchronous': 'OFF',
+             'cache_size': '-262144', 'mmap_size': '1073741824',
+             'temp_store': 'MEMORY'},
+}
+
 class Config:
     def __init__(self):
         self.path = os.path.join(
@@ -27,8 +42,10 @@ class Config:
             self.config.write(configfile)
 
     def create(self):
-        self.config['dbase'] = {'command': self.raw_sql}
+        self.config['dbase'] = {'command': self.raw_sql,
+                                'profile': 'default'}
         self.config['logging'] = {'config': 'None.ini'}
+        self.config['indexing'] = {'batchsize': '500'}
         self.save()
 
     def getSQLCommand(self):
@@ -38,10 +55,71 @@ class Config:
     def setSQLCommand(self, command):
         self.config['dbase']['command'] = command
 
+    def getBatchSize(self):
+        """Number of books saved in one transaction while indexing."""
+        return self.config.getint('indexing', 'batchsize',
+                                  fallback = 500)
+
+    def getJournalName(self, command, path):
+        """Checkpoint journal of indexing path to database."""
+        key = "{}\n{}".format(command, os.path.abspath(path))
+        name = hashlib.sha1(key.encode('utf-8')).hexdigest()[:16]
+        return os.path.join(self.path, 'journal', name + '.jsonl')
+
+    def getIgnore(self):
+        """Glob patterns of names of directories not walked
+        by indexing, zipping and testing."""
+        value = self.config.get('indexing', 'ignore', fallback = '')
+        return [p.strip() for p in value.split(',') if p.strip()]
+
+    def setBatchSize(self, size):
+        if not self.config.has_section('indexing'):
+            self.config['indexing'] = {}
+        self.config['indexing']['batchsize'] = str(size)
+
+    def getProfileName(self):
+        """Storage profile used by BookManager."""
+        return self.config.get('dbase', 'profile', fallback = 'default')
+
+    def getProfile(self, name=None):
+        """PRAGMAs of storage profile, section [profile NAME]
+        overrides built-in profile with same name."""
+        if name is None:
+            name = self.getProfileName()
+        section = 'profile {}'.format(name)
+        if name not in PROFILES and not self.config.has_section(section):
+            raise ValueError("Unknown storage profile: {}".format(name))
+        pragmas = dict(PROFILES.get(name, {}))
+        if self.config.has_section(section):
+            pragmas.update(self.config[section])
+        return pragmas
+
+    def getPoolOptions(self):
+        """Options of connection pool for BookManager:
+        pool_size and max_overflow from section dbase."""
+        options = {}
+        for name in ('pool_size', 'max_overflow'):
+            value = self.config.get('dbase', name, fallback = None)
+            if value is not None:
+                options[name] = int(value)
+        return options
+
+    def getQueryCache(self):
+        """Size (0 - no cache) and time to live in seconds
+        of cache of menu queries."""
+        size = self.config.getint('cache', 'size', fallback = 256)
+        ttl = self.config.getfloat('cache', 'ttl', fallback = 300)
+        return size, ttl or None
+
+    def getTestCacheName(self):
+        """File with cached results of zipper tests."""
+        return self.config.get('zipper', 'testcache',
+                    fallback = os.path.join(self.path, 'testcache.db'))
+
     def getLogConfigName(self):
         r = self.config.get('logging', 'config',
                                 fallback = 'None.ini')
-        if r is not 'None.ini':
+        if r != 'None.ini':
             return r
         else:
             return None
@@ -0,0 +1,353 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+from elib.models import Book, Author, Genre, author_books
+from elib import search
+from elib.names import TrigramIndex
+from elib.cache import cached, sessionkey
+from sqlalchemy import or_, and_, select, func
+from sqlalchemy.orm import lazyload, selectinload, joinedload, subqueryload
+
+__doc__ = """Queries to library database.
+
+Example:
+    c = Counterman(BookManager(command))
+    for book in c.page(c.brief(c.query_all_books())):
+        print(book.authors, book.title)"""
+
+# Strategies of loading Book.authors and Book.genres
+LOADERS = {'lazy': lazyload,
+           'select': lazyload,
+           'selectin': selectinload,
+           'joined': joinedload,
+           'subquery': subqueryload,
+           }
+
+# Order of pages: sort column and unique id
+SORTKEYS = {Book: (Book.title, Book.id),
+            Author: (Author.lastname, Author.id),
+            Genre: (Genre.name, Genre.id),
+            }
+
+PAGESIZE = 50
+
+
+class Page(list):
+    """One page of results.
+    cursor - position for next page or None for last page."""
+    cursor = None
+
+
+def greater(key, value):
+    """key > value, NULL is less than any value
+    as in ascending order of SQLite."""
+    if value is None:
+        return key.isnot(None)
+    return key > value
+
+
+def equal(key, value):
+    """key == value, also for NULL value."""
+    if value is None:
+        return key.is_(None)
+    return key == value
+
+
+def after(keys, cursor):
+    """Condition for keyset pagination:
+    row is after cursor in order of keys.
+    Sort keys may be NULL (Author.lastname)."""
+    cond = greater(keys[-1], cursor[-1])
+    for key, value in zip(reversed(keys[:-1]), reversed(cursor[:-1])):
+        cond = or_(greater(key, value), and_(equal(key, value), cond))
+    return cond
+
+
+def authorsline():
+    """Correlated subquery with names of authors of book
+    in one string, like str(book.authors)."""
+    a = Author.__table__.alias()
+    ab = author_books.alias()
+    name = a.c.lastname + ' ' + func.coalesce(a.c.firstname, '')
+    return select([func.group_concat(name, ',')]).\
+                where(ab.c.book_id == Book.id).\
+                where(a.c.id == ab.c.author_id).\
+                correlate(Book.__table__).\
+                as_scalar().label('authors')
+
+
+class Counterman:
+    """Сlass extends the functionality of BookManager.
+    Counterman could inherit from the BookManager, but you can
+    use one object manager, instead of creating a variety of others.
+    authors, genres - strategy of loading relations of books
+    (keys of LOADERS): by default authors are loaded for all
+    books of query by one more query and genres when accessed;
+    cache - QueryCache for results of get_*, search and page,
+    it is cleared when crawler changes catalog."""
+
+    def __init__(self, manager, authors='selectin', genres='lazy',
+                 cache=None):
+        self.manager = manager
+        self.fts = search.exists(manager.engine)
+        self.authors = authors
+        self.genres = genres
+        self.cache = cache
+        # Trigram index of authors names and version of catalog
+        self.trigrams = None
+        self.trigramsversion = None
+
+    @property
+    def session(self):
+        """Session of current thread."""
+        return self.manager.getsession()
+
+    def __loaders(self, streaming=False):
+        """Loader options for Book queries.
+        Joined and subquery loading of collections do not work
+        with yield_per, so they are replaced with selectin
+        for streaming."""
+        options = []
+        for attr, strategy in ((Book.authors, self.authors),
+                               (Book.genres, self.genres)):
+            if streaming and strategy in ('joined', 'subquery'):
+                strategy = 'selectin'
+            options.append(LOADERS[strategy](attr))
+        return options
+
+    def books(self):
+        """Base query of books with loader options."""
+        return self.session.query(Book).options(*self.__loaders())
+
+    def brief(self, query):
+        """Projection of query_* method for books:
+        query of plain rows (id, title, authors) in one SQL
+        query without loading of objects and relations."""
+        return query.with_entities(Book.id, Book.title, authorsline())
+
+    # Queries for lists are built by query_* methods:
+    # get_* loads whole list, iterate and page read them by parts.
+    #Authors
+    def query_all_authors(self):
+        return self.session.query(Author).\
+                order_by(Author.lastname)
+
+    @cached
+    def get_all_authors(self):
+        """All Authors"""
+        return self.query_all_authors().all()
+
+    @cached
+    def get_author_by_id(self, id_):
+        """Get author by id"""
+        return self.session.query(Author).\
+                filter(Author.id == id_).one()
+
+    def query_authors_by_name(self, lastname, firstname=None):
+        obj = self.session.query(Author).filter(
+                        Author.lastname == lastname)
+        if firstname:
+            obj = obj.filter(Author.firstname == firstname)
+        return obj.order_by(Author.lastname)
+
+    @cached
+    def get_authors_by_name(self, lastname, firstname=None):
+        """Get authors by name (lastname and/or firstname)"""
+        return self.query_authors_by_name(lastname, firstname).all()
+
+    def authorindex(self):
+        """Trigram index of authors, new authors are added
+        when catalog is changed, it is built again
+        if authors are merged or deleted."""
+        version = self.manager.version
+        if self.trigrams is not None and self.trigramsversion == version:
+            return self.trigrams
+        if self.trigrams is not None:
+            count = self.session.query(func.count(Author.id)).scalar()
+            if count < len(self.trigrams):
+                self.trigrams = None
+        if self.trigrams is None:
+            self.trigrams = TrigramIndex()
+        self.trigrams.load(self.session)
+        self.trigramsversion = version
+        return self.trigrams
+
+    @cached
+    def get_authors_by_similar_name(self, name, limit=10):
+        """Get authors by similar name (fuzzy search)"""
+        ids = [id_ for similarity, id_ in
+               self.authorindex().find(name, limit)]
+        if not ids:
+            return []
+        authors = dict((a.id, a) for a in self.session.query(Author).\
+                            filter(Author.id.in_(ids)))
+        return [authors[id_] for id_ in ids if id_ in authors]
+
+    #Genres
+    def query_all_genres(self):
+        return self.session.query(Genre).\
+                    order_by(Genre.name)
+
+    @cached
+    def get_all_genres(self):
+        """All Genres"""
+        return self.query_all_genres().all()
+
+    @cached
+    def get_genre_by_name(self, name):
+        """Get genre by name"""
+        return self.session.query(Genre).\
+                    filter(Genre.name == name).one()
+
+    @cached
+    def get_genre_by_id(self, id_):
+        """Get genre by id"""
+        return self.session.query(Genre).\
+                    filter(Genre.id == id_).one()
+
+    #Books
+    def query_all_books(self):
+        return self.books().\
+                    order_by(Book.title)
+
+    @cached
+    def get_all_books(self):
+        """All Books"""
+        return self.query_all_books().all()
+
+    @cached
+    def get_book_by_id(self, id_):
+        """Get book by id"""
+        return self.session.query(Book).\
+                    filter(Book.id == id_).one()
+
+    def query_books_by_title(self, title):
+        return self.books().\
+                    filter(Book.title == title).\
+                    order_by(Book.title)
+
+    @cached
+    def get_books_by_title(self, title):
+        """Get books by title"""
+        return self.query_books_by_title(title).all()
+
+    def query_books_by_lang(self, lang):
+        return self.books().\
+                    filter(Book.lang == lang).\
+                    order_by(Book.title)
+
+    @cached
+    def get_books_by_lang(self, lang):
+        """Get books by language"""
+        return self.query_books_by_lang(lang).all()
+
+    def query_books_by_author_id(self, id_):
+        return self.books().\
+                    join(Book.authors).\
+                    filter(Author.id == id_).\
+                    order_by(Book.title)
+
+    @cached
+    def get_books_by_author_id(self, id_):
+        """Get books by author id"""
+        return self.query_books_by_author_id(id_).all()
+
+    def query_books_by_genre(self, genre):
+        return self.books().\
+                    join(Book.genres).\
+                    filter(Genre.name == genre).\
+                    order_by(Book.title)
+
+    @cached
+    def get_books_by_genre(self, genre):
+        """Get book by genre name"""
+        return self.query_books_by_genre(genre).all()
+
+    @cached
+    def get_book_by_path(self, path):
+        """Get book by path"""
+        return self.session.query(Book).\
+                    filter(Book.path == path).one()
+
+    #Streaming and pages
+    def iterate(self, query, size=PAGESIZE):
+        """Iterate over results of query_* method,
+        rows are loaded from database by size at once."""
+        if query.column_descriptions[0]["type"] is Book:
+            query = query.options(*self.__loaders(streaming=True))
+        return iter(query.yield_per(size))
+
+    def page(self, query, size=PAGESIZE, cursor=None):
+        """Return Page of results of query_* method after cursor.
+        Keyset pagination: rows are ordered by sort key of model
+        and id, so every page costs same time."""
+        if self.cache is not None:
+            # Queries are built again for every page, so key is SQL;
+            # objects of page belong to session of current thread
+            compiled = query.statement.compile()
+            key = (sessionkey(self.session), "page", str(compiled),
+                   tuple(sorted(compiled.params.items())), size, cursor)
+            self.cache.check(self.manager.version)
+            found, page = self.cache.get(key)
+            if not found:
+                page = self.__page(query, size, cursor)
+                self.cache.put(key, page)
+            return page
+        return self.__page(query, size, cursor)
+
+    def __page(self, query, size, cursor):
+        keys = SORTKEYS[query.column_descriptions[0]["entity"]]
+        if cursor is not None:
+            query = query.filter(after(keys, cursor))
+        rows = query.order_by(None).order_by(*keys).\
+                    limit(size + 1).all()
+        page = Page(rows[:size])
+        if len(rows) > size:
+            last = page[-1]
+            page.cursor = tuple(getattr(last, key.key) for key in keys)
+        return page
+
+    @cached
+    def get_books_by_words(self, query):
+        """Search books by words of title or authors"""
+        return self.search(query)
+
+    @cached
+    def search(self, query, limit=50):
+        """Return books with all words of query (or their beginnings)
+        in title or authors names, best matched first.
+        Without full-text index only titles and last names
+        are searched with LIKE."""
+        if not self.fts:
+            pattern = "%{}%".format(query)
+            return self.books().\
+                    outerjoin(Book.authors).\
+                    filter(or_(Book.title.like(pattern),
+                               Author.lastname.like(pattern))).\
+                    distinct().order_by(Book.title).\
+                    limit(limit).all()
+        ids = search.find(self.session, query, limit)
+        if not ids:
+            return []
+        books = dict((b.id, b) for b in self.books().\
+                            filter(Book.id.in_(ids)))
+        return [books[id_] for id_ in ids if id_ in books]
+
+    def info_for_options(self):
+        """Info about class features.
+        For auto create menu."""
+        cls_dict = type(self).__dict__
+        list_ = []
+        n = 1
+        for key in cls_dict.keys():
+            if key.startswith("get"):
+                d = {"func": cls_dict[key],
+                    "doc": cls_dict[key].__doc__,
+                    "fname": key,
+                    }
+                list_.append(d)
+            list_ = sorted(list_, key=lambda x: x["doc"])
+        d = {}
+        for i in list_:
+            d[n] = i
+            n +=1
+        return d
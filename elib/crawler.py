@@ -1,14 +1,45 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 import os
-from elib.models import Book, Author, Genre
+import zlib
+import hashlib
+import zipfile
+import traceback
+from io import BytesIO
+from functools import partial
+from contextlib import nullcontext
+from elib.models import Book, Author, Genre, BookFile, Duplicate
+from elib.models import author_books, book_genres
 from elib.manager import BookManager
-from elib.zipper import InvalidZipFile, ZipReader
+from elib.config import PROFILES
+from elib.zipper import InvalidZipFile, ZipReader, filehash
+from elib.pool import imap
+from elib.metrics import timed, filetype
+from elib.scanner import scan, prefetch, withdata
+from elib import search, migrate, names
 try:
     from lxml import etree
 except ImportError:
     print("Failed to import lxml module.")
-from sqlalchemy.orm.exc import NoResultFound
+else:
+    # Compiled once, evaluated relative to <title-info> or OPF root.
+    FB2NS = {'n': 'http://www.gribuser.ru/xml/fictionbook/2.0'}
+    FB2_TITLEINFO = '{{{}}}title-info'.format(FB2NS['n'])
+    FB2_DESCRIPTION = '{{{}}}description'.format(FB2NS['n'])
+    FB2_TITLE = etree.XPath('n:book-title', namespaces=FB2NS)
+    FB2_GENRES = etree.XPath('n:genre', namespaces=FB2NS)
+    FB2_LANG = etree.XPath('n:lang', namespaces=FB2NS)
+    FB2_AUTHORS = etree.XPath('n:author', namespaces=FB2NS)
+    FB2_FIRSTNAME = etree.XPath('n:first-name', namespaces=FB2NS)
+    FB2_LASTNAME = etree.XPath('n:last-name', namespaces=FB2NS)
+    EPUBNS = {'n': 'urn:oasis:names:tc:opendocument:xmlns:container',
+              'dc': 'http://purl.org/dc/elements/1.1/'}
+    EPUB_ROOTFILE = etree.XPath('//n:rootfile', namespaces=EPUBNS)
+    EPUB_TITLE = etree.XPath('//dc:title', namespaces=EPUBNS)
+    EPUB_CREATOR = etree.XPath('//dc:creator', namespaces=EPUBNS)
+    EPUB_LANG = etree.XPath('//dc:language', namespaces=EPUBNS)
+    EPUB_SUBJECTS = etree.XPath('//dc:subject', namespaces=EPUBNS)
+from sqlalchemy import bindparam, or_
 import logging
 
 __doc__ = """Module for walking in library and makes indexing files
@@ -20,94 +51,691 @@ Example:
     cm.run(args.path)
     #or
     cm.addfile(args.path)
+    #or parse files in 4 worker processes
+    cm = CrawlerManager(manager, jobs=4)
+    cm.run(args.path)
     q = manager.query(Book)
     for row in q.all():
         print(row)"""
 
+BATCHSIZE = 500
+EXTENSIONS = ('.fb2', '.fb2.zip', '.epub')
+
+class InvalidBookFile(Exception):
+    """File has no required book information."""
+    pass
+
+
+def fb2header(file):
+    """Return <title-info> element of fb2 document.
+    Document is read only until </title-info> closes,
+    so body and binaries (covers, illustrations) are not parsed.
+    file - file name or file-like object."""
+    context = etree.iterparse(file, events=('end',),
+                              tag=(FB2_TITLEINFO, FB2_DESCRIPTION))
+    for event, elem in context:
+        if elem.tag == FB2_TITLEINFO:
+            return elem
+        # </description> closed without <title-info>
+        break
+    raise InvalidBookFile("No <title-info> in document")
+
+def source(filename, data=None):
+    """File-like object with data or filename, if data is not read."""
+    if data is None:
+        return filename
+    return BytesIO(data)
+
+def parsebooks(filename, verify=False, data=None):
+    """Return list of books information in file
+    (fb2 archive may contain several books),
+    empty list for unknown type of file.
+    verify - check CRC of all files in archive before reading;
+    data - content of file if it is already read."""
+    if filename.endswith(".fb2.zip"):
+        return BookInfo.fromfb2zip(filename, verify, data)
+    info = BookInfo().parsefile(filename, verify, data)
+    return [info] if info is not None else []
+
+def ownedby(path, files):
+    """True if book path is one of files or
+    path of book in archive from files."""
+    while True:
+        if path in files:
+            return True
+        path, sep, member = path.rpartition('/')
+        if not sep:
+            return False
+
+def under(column, path):
+    """Condition of column with path or paths inside it
+    (books of archive, files of directory)."""
+    return or_(column == path,
+               column.startswith(path + '/', autoescape=True))
+
+def parserecord(filename, verify=False, data=None, hashing=False):
+    """Parse one file, may be called in worker process.
+    data - content of file if it is already read;
+    hashing - also compute SHA-1 of content for state of file.
+    Return tuple (filename, records, error):
+    records - list of plain dictionaries with book information;
+    error - tuple (logging level, message) or None;
+    with hashing - (filename, records, error, hash)."""
+    if not hashing:
+        return readrecords(filename, verify, data)
+    try:
+        hash_ = filehash(filename) if data is None else \
+                hashlib.sha1(data).hexdigest()
+    except OSError:
+        hash_ = None
+    return readrecords(filename, verify, data) + (hash_,)
+
+def readrecords(filename, verify=False, data=None):
+    """parserecord without hashing."""
+    try:
+        records = [dict(info) for info in
+                   parsebooks(filename, verify, data)]
+        return filename, records, None
+    except etree.XMLSyntaxError as e:
+        return filename, [], (logging.WARNING,
+                              "{}: {}".format(e, filename))
+    except InvalidZipFile as e:
+        return filename, [], (logging.WARNING, str(e))
+    except (zipfile.BadZipFile, zlib.error) as e:
+        return filename, [], (logging.WARNING,
+                              "{}: {}".format(e, filename))
+    except InvalidBookFile as e:
+        return filename, [], (logging.WARNING,
+                              "{}: {}".format(e, filename))
+    except Exception as e:
+        return filename, [], (logging.ERROR,
+                                "{}: {}\n{}".format(e, filename,
+                                            traceback.format_exc()))
+
+
 class Crawler:
-    """Crawler class for indexing ebooks."""
-    def __init__(self, path=None, logger=None):
+    """Crawler class for indexing ebooks.
+    jobs - number of worker processes for parsing files
+    (1 parses files in current process);
+    maxqueue - how many parsed files may wait for registration
+    (by default 4 per worker);
+    verify - check CRC of whole archive before reading,
+    by default only members with book information are read
+    (use zipper.testpath for full check);
+    metrics - elib.metrics.Metrics for timings of stages;
+    progress - elib.progress.Progress for reports while walking;
+    ignore - glob patterns of names of directories not walked;
+    prefetch - number of files read ahead of parser by reader
+    threads (0 - parser reads files itself)."""
+    # Only files with these endings are walked, None - all files
+    extensions = None
+    # Content of files is hashed by parser (in worker process)
+    hashing = False
+
+    def __init__(self, path=None, logger=None, jobs=1, maxqueue=None,
+                 verify=False, metrics=None, progress=None,
+                 ignore=None, prefetch=0):
         self.path = path
         self.logger = logger or logging.getLogger(__name__)
+        self.jobs = jobs
+        self.maxqueue = maxqueue
+        self.verify = verify
+        self.metrics = metrics
+        self.progress = progress
+        self.ignore = ignore
+        self.prefetch = prefetch
+
+    def timer(self, stage, **labels):
+        """Context manager timing stage if metrics are collected."""
+        if self.metrics is None:
+            return nullcontext()
+        return self.metrics.timer(stage, **labels)
     
     def registerbook(self, dict_):
         """Register book info in database."""
         pass
 
+    def handlerecord(self, filename, records, error, hash_=None):
+        """Register result of parserecord.
+        Always called in current (writer) process."""
+        if error:
+            self.logger.log(*error)
+        for record in records:
+            try:
+                self.registerbook(BookInfo(record))
+            except Exception as e:
+                self.logger.exception("{}: {}".format(e, filename))
+
     def addfile(self, filename):
         """Register single file to index."""
-        binfo = BookInfo()
-        try:
-            info = binfo.parsefile(filename)
-            if info:
-                self.registerbook(info)
-        except etree.XMLSyntaxError as e:
-            self.logger.warning("{}: {}".\
-                        format(e, filename))
-        except InvalidZipFile as e:
-            self.logger.warning(e)
-        except Exception as e:
-            self.logger.exception("{}: {}".format(e, filename))
+        self.handlerecord(*parserecord(filename, self.verify))
 
+    def files(self):
+        """Walk on self.path. Return filename."""
+        return scan(self.path, self.extensions, self.ignore,
+                    onerror=self.logger.warning)
+
+    def filesize(self, filename):
+        """Size of file for progress if it is known
+        without stat, else None."""
+        return None
 
     def walk(self, path=None):
-        """Main function for indexing path."""
-        binfo = BookInfo()
+        """Main function for indexing path.
+        Files are parsed in worker processes (if jobs > 1)
+        and registered in walk order, so result is same
+        as for serial run."""
         if path:
             self.path = path
-        for base, dirs, files in os.walk(self.path):
-            for file in files:
-                name = os.path.join(base, file)
-                self.addfile(name)
+        parse = partial(parserecord, verify=self.verify,
+                        hashing=self.hashing)
+        files = self.files()
+        metrics = self.metrics
+        progress = self.progress
+        if metrics is not None:
+            files = metrics.timeiter('walk', files)
+        if self.prefetch:
+            files = prefetch(files, self.prefetch)
+            parse = partial(withdata, parse)
+            if metrics is not None:
+                # Time of waiting for reader threads
+                files = metrics.timeiter('read', files)
+        if metrics is not None:
+            # Parsing is timed where it runs, maybe in worker process
+            parse = partial(timed, parse)
+        for result in imap(parse, files, self.jobs, self.maxqueue):
+            if progress is not None:
+                # Known before handlerecord forgets state of file
+                size = self.filesize(result[0] if metrics is None
+                                     else result[0][0])
+            if metrics is None:
+                self.handlerecord(*result)
+            else:
+                result, seconds = result
+                filename, records, error = result[:3]
+                kind = filetype(filename)
+                metrics.observe('parse', seconds, type=kind)
+                metrics.count('files', type=kind)
+                metrics.count('books', len(records), type=kind)
+                if error:
+                    metrics.count('errors', type=kind)
+                with metrics.timer('register', type=kind):
+                    self.handlerecord(*result)
+            if progress is not None:
+                progress.add(result[0], size, error=result[2] is not None)
+
+
+def chunks(list_, size=500):
+    """Split list to parts for IN clauses
+    (SQLite limits number of query parameters)."""
+    for i in range(0, len(list_), size):
+        yield list_[i:i + size]
 
 
 class CrawlerManager(Crawler):
-    def __init__(self,  manager, path=None, logger=None):
-        """Crawler or path for indexing"""
+    def __init__(self,  manager, path=None, logger=None,
+                 jobs=1, maxqueue=None, batchsize=BATCHSIZE,
+                 incremental=False, hashing=False, verify=False,
+                 bulk=None, metrics=None, progress=None,
+                 ignore=None, prefetch=0, journal=None):
+        """Crawler or path for indexing.
+        batchsize - number of books saved in one transaction,
+        interrupted run loses at most one batch;
+        incremental - parse only new or changed files
+        and remove books of deleted files;
+        hashing - compare content hash of files with changed mtime;
+        verify - check CRC of archives before reading;
+        bulk - storage profile (PRAGMAs) for bulk load in run:
+        secondary indexes are dropped while loading,
+        then rebuilt and ANALYZE is run;
+        journal - elib.journal.Journal, checkpoint is written after
+        every batch and files before its checkpoint are skipped."""
+        super().__init__(path, logger, jobs, maxqueue, verify, metrics,
+                         progress, ignore, prefetch)
+        self.extensions = EXTENSIONS
         self.manager = manager
-        self.path = path
-        self.logger = logger or logging.getLogger(__name__)
-        self.session = self.manager.getsession()
+        self.fts = search.exists(self.manager.engine)
+        self.batchsize = max(1, batchsize or 1)
+        self.incremental = incremental
+        self.hashing = hashing
+        self.bulk = bulk
+        self.journal = journal
+        # Last file with all books registered
+        self.handled = None
+        self.batch = []
+        # File states: saved ones (path -> (size, mtime, hash)),
+        # of files in work and waiting for flush.
+        self.known = None
+        self.states = {}
+        self.filestats = []
+        # Changed files and their new books paths
+        self.changed = set()
+        self.stale = []
+        # Identity maps: (lastname, firstname) -> author id,
+        # normalized name (names.key) -> author id,
+        # genre name -> genre id. Loaded on first flush.
+        self.authors = None
+        self.names = None
+        self.genres = None
+
+    @property
+    def session(self):
+        """Session of current thread."""
+        return self.manager.getsession()
 
     def registerbook(self, dict_):
         """Register one book info in database.
+        Book is saved with next batch.
         dict_ - dictionary with book information"""
-        a_list = []
+        if dict_.title is None or dict_.lang is None:
+            # Would fail the whole batch on NOT NULL constraint
+            self.logger.warning("No title or language: {}".format(
+                                dict_.path))
+            return
+        # Empty <author/> and <genre/> are dropped for the same reason
+        authors = []
         for element in dict_.authors:
+            key = (element["lastname"], element["firstname"])
+            if any(key) and key not in authors:
+                authors.append(key)
+        genres = []
+        for name in dict_.genres:
+            if name and name not in genres:
+                genres.append(name)
+        self.batch.append({"title": dict_.title,
+                           "lang": dict_.lang,
+                           "path": dict_.path,
+                           "authors": authors,
+                           "genres": genres,
+                           })
+
+    def loadmaps(self):
+        """Fill identity maps with authors and genres from database."""
+        self.authors = {}
+        self.names = {}
+        for id_, lastname, firstname in self.session.query(
+                        Author.id, Author.lastname, Author.firstname).\
+                        order_by(Author.id):
+            self.authors.setdefault((lastname, firstname), id_)
+            self.names.setdefault(names.key(lastname, firstname), id_)
+        self.genres = dict((name, id_) for id_, name in
+                            self.session.query(Genre.id, Genre.name))
+
+    def __addauthors(self, keys):
+        """Bulk insert unknown authors and remember their ids."""
+        table = Author.__table__
+        self.session.execute(table.insert(),
+                [{"lastname": l, "firstname": f} for l, f in keys])
+        keys = set(keys)
+        lastnames = list(set(l for l, f in keys if l is not None))
+        filters = [Author.lastname.in_(part) for part in chunks(lastnames)]
+        if any(l is None for l, f in keys):
+            # IN never matches NULL
+            filters.append(Author.lastname.is_(None))
+        for filter_ in filters:
+            q = self.session.query(Author.id, Author.lastname,
+                                   Author.firstname).filter(filter_)
+            for id_, lastname, firstname in q:
+                if (lastname, firstname) in keys:
+                    self.authors.setdefault((lastname, firstname), id_)
+                    self.names.setdefault(names.key(lastname, firstname),
+                                          id_)
+
+    def __addgenres(self, names):
+        """Bulk insert unknown genres and remember their ids."""
+        self.session.execute(Genre.__table__.insert(),
+                             [{"name": name} for name in names])
+        for part in chunks(names):
+            q = self.session.query(Genre.id, Genre.name).\
+                    filter(Genre.name.in_(part))
+            self.genres.update((name, id_) for id_, name in q)
+
+    def __bookids(self, paths):
+        """Return dictionary path -> id for saved books."""
+        ids = {}
+        for part in chunks(paths):
+            q = self.session.query(Book.id, Book.path).\
+                    filter(Book.path.in_(part))
+            ids.update((path, id_) for id_, path in q)
+        return ids
+
+    def files(self):
+        """Walk on self.path. Return filename of ebook.
+        In incremental mode unchanged files are skipped,
+        with journal - files committed by interrupted run."""
+        for name in super().files():
+            if self.done(name):
+                # Committed by interrupted run, not even stat-ed
+                if self.known is not None:
+                    self.known.pop(name, None)
+                continue
             try:
-                a = Author.get(self.session,
-                                element["lastname"],
-                                element["firstname"])
-            except NoResultFound:
-                a = Author(element["lastname"],
-                           element["firstname"])
-            self.session.add(a)
-            a_list.append(a)
-
-        genre_list = []
-        genres = dict_.genres
-        for name in genres:
+                st = os.stat(name)
+            except OSError as e:
+                self.logger.warning(e)
+                continue
+            hash_ = None
+            if self.known is not None and name in self.known:
+                size, mtime, oldhash = self.known.pop(name)
+                if size == st.st_size and mtime == st.st_mtime:
+                    continue
+                if self.hashing and oldhash and size == st.st_size:
+                    hash_ = filehash(name)
+                    if hash_ == oldhash:
+                        self.__addstate(name, st, hash_)
+                        continue
+                self.changed.add(name)
+            # Otherwise file is hashed by parserecord in worker
+            self.states[name] = (st, hash_)
+            yield name
+
+    def __addstate(self, name, st, hash_):
+        self.filestats.append({"path": name,
+                               "size": st.st_size,
+                               "mtime": st.st_mtime,
+                               "hash": hash_})
+        if len(self.filestats) >= self.batchsize:
+            self.flush()
+
+    def handlerecord(self, filename, records, error, hash_=None):
+        """Register result of parserecord and state of file,
+        hash_ - hash of content computed by parserecord."""
+        if filename in self.changed and not error:
+            # Books removed from changed archive must be deleted
+            self.changed.remove(filename)
+            self.stale.append((filename,
+                               set(record["path"] for record in records)))
+        super().handlerecord(filename, records, error)
+        self.handled = filename
+        if filename in self.states:
+            st, known = self.states.pop(filename)
+            self.__addstate(filename, st, hash_ or known)
+        # Not in registerbook: failed batch must fail the run,
+        # not be logged as error of one book
+        if len(self.batch) >= self.batchsize:
+            self.flush()
+
+    def done(self, filename):
+        """True if file is indexed by interrupted run, which
+        is resumed now."""
+        return self.journal is not None and self.journal.done(filename)
+
+    def filesize(self, filename):
+        state = self.states.get(filename)
+        return None if state is None else state[0].st_size
+
+    def loadstates(self):
+        """Load saved states of files in self.path."""
+        prefix = os.path.join(self.path, '')
+        q = self.session.query(BookFile.path, BookFile.size,
+                               BookFile.mtime, BookFile.hash).\
+                filter(BookFile.path.startswith(prefix, autoescape=True))
+        self.known = dict((path, (size, mtime, hash_))
+                          for path, size, mtime, hash_ in q)
+
+    def prune(self, paths):
+        """Remove books and states of deleted files."""
+        paths = set(paths)
+        if not paths:
+            return
+        prefix = os.path.join(self.path, '')
+        q = self.session.query(Book.id, Book.path).\
+                filter(Book.path.startswith(prefix, autoescape=True))
+        self.__deletebooks([id_ for id_, path in q if ownedby(path, paths)])
+        for part in chunks(list(paths)):
+            self.session.execute(BookFile.__table__.delete().\
+                        where(BookFile.path.in_(part)))
+        self.session.commit()
+        self.manager.changed()
+        self.logger.info("Removed {} deleted files from index".\
+                         format(len(paths)))
+
+    def __deletebooks(self, ids):
+        """Delete books with their relations."""
+        self.__unlink(ids)
+        for part in chunks(ids):
+            self.session.execute(Duplicate.__table__.delete().\
+                    where(Duplicate.book_id.in_(part)))
+            self.session.execute(Book.__table__.delete().\
+                    where(Book.id.in_(part)))
+
+    def __dropstale(self, stale):
+        """Delete books of changed files which are not in files now."""
+        ids = []
+        for filename, keep in stale:
+            q = self.session.query(Book.id, Book.path).\
+                    filter(under(Book.path, filename))
+            ids.extend(id_ for id_, path in q if path not in keep)
+        self.__deletebooks(ids)
+
+    def __unlink(self, ids):
+        """Delete relations of books with authors and genres
+        and their full-text index."""
+        if self.fts:
+            search.remove(self.session, ids)
+        for part in chunks(ids):
+            self.session.execute(author_books.delete().\
+                    where(author_books.c.book_id.in_(part)))
+            self.session.execute(book_genres.delete().\
+                    where(book_genres.c.book_id.in_(part)))
+
+    def __savestates(self, stats):
+        """Insert or update file states."""
+        ids = {}
+        for part in chunks([row["path"] for row in stats]):
+            q = self.session.query(BookFile.id, BookFile.path).\
+                    filter(BookFile.path.in_(part))
+            ids.update((path, id_) for id_, path in q)
+        old = [dict(row, file_id=ids[row["path"]])
+               for row in stats if row["path"] in ids]
+        if old:
+            self.session.execute(BookFile.__table__.update().\
+                        where(BookFile.id == bindparam("file_id")),
+                    old)
+        new = [row for row in stats if row["path"] not in ids]
+        if new:
+            self.session.execute(BookFile.__table__.insert(), new)
+
+    def flush(self):
+        """Save batch of registered books and
+        states of their files in one transaction."""
+        if not self.batch and not self.filestats and not self.stale:
+            return
+        if self.authors is None:
+            self.loadmaps()
+        batch, self.batch = self.batch, []
+        stats, self.filestats = self.filestats, []
+        stale, self.stale = self.stale, []
+        try:
+            with self.timer('flush'):
+                if stale:
+                    self.__dropstale(stale)
+                self.__save(batch)
+                if stats:
+                    self.__savestates(stats)
+                self.session.commit()
+            self.manager.changed()
+            if self.journal is not None:
+                # Current file may be saved partly, it is not done
+                self.journal.commit(self.handled, len(batch))
+        except:
+            self.session.rollback()
+            # Maps may contain ids of rolled back rows.
+            self.authors = self.names = self.genres = None
+            raise
+
+    def __save(self, batch):
+        newauthors = []
+        # Names of new authors -> saved variant of name
+        variants = {}
+        saved = {}
+        newgenres = []
+        for book in batch:
+            for key in book["authors"]:
+                if key in self.authors or key in variants:
+                    continue
+                normal = names.key(*key)
+                if normal in self.names:
+                    # Other variant of known name
+                    self.authors[key] = self.names[normal]
+                elif normal in saved:
+                    variants[key] = saved[normal]
+                else:
+                    saved[normal] = variants[key] = key
+                    newauthors.append(key)
+            for name in book["genres"]:
+                if name not in self.genres and name not in newgenres:
+                    newgenres.append(name)
+        if newauthors:
+            self.__addauthors(newauthors)
+            for key, name in variants.items():
+                self.authors[key] = self.authors[name]
+        if newgenres:
+            self.__addgenres(newgenres)
+
+        books = self.__bookids([book["path"] for book in batch])
+        if books:
+            # Books are indexed again: update them and their relations.
+            self.__unlink(list(books.values()))
+            self.session.execute(Book.__table__.update().\
+                        where(Book.id == bindparam("book_id")),
+                    [{"book_id": books[book["path"]],
+                      "title": book["title"],
+                      "lang": book["lang"]}
+                     for book in batch if book["path"] in books])
+        new = [book for book in batch if book["path"] not in books]
+        if new:
+            self.session.execute(Book.__table__.insert(),
+                    [{"title": book["title"],
+                      "lang": book["lang"],
+                      "path": book["path"]} for book in new])
+            books.update(self.__bookids([book["path"] for book in new]))
+
+        # Variants of one name in book are one author
+        rows = [{"book_id": books[book["path"]], "author_id": id_}
+                for book in batch
+                for id_ in dict.fromkeys(self.authors[key]
+                                         for key in book["authors"])]
+        if rows:
+            self.session.execute(author_books.insert(), rows)
+        rows = [{"book_id": books[book["path"]],
+                 "genre_id": self.genres[name]}
+                for book in batch for name in book["genres"]]
+        if rows:
+            self.session.execute(book_genres.insert(), rows)
+        if self.fts:
+            search.add(self.session,
+                       [{"id": books[book["path"]],
+                         "title": book["title"],
+                         "authors": search.authorsline(book["authors"])}
+                        for book in batch])
+
+    def addfile(self, filename):
+        """Register single file to index and save it."""
+        super().addfile(filename)
+        self.flush()
+
+    def update(self, names):
+        """Index again new or changed files and save them
+        in one batch, books which are not in files now are deleted."""
+        for name in names:
             try:
-                g = Genre.get(self.session, name)
-            except NoResultFound:
-                g = Genre(name)
-            self.session.add(g)
-            genre_list.append(g)
+                st = os.stat(name)
+            except OSError as e:
+                self.logger.warning(e)
+                continue
+            self.changed.add(name)
+            self.states[name] = (st, None)
+            self.handlerecord(*parserecord(name, self.verify,
+                                           hashing=self.hashing))
         try:
-            b = Book.get(self.session, 
-                        dict_.title,dict_.lang, 
-                        a_list, genre_list, dict_.path)
-        except NoResultFound:
-            b = Book(dict_.title,dict_.lang, 
-                     a_list, genre_list, dict_.path)
-        self.session.add(b)
-        self.session.commit()
-    
+            self.flush()
+        finally:
+            self.changed.clear()
+            self.states.clear()
+
+    def remove(self, paths):
+        """Remove books and states of deleted files or directories."""
+        try:
+            self.__remove(paths)
+            self.session.commit()
+        except:
+            self.session.rollback()
+            raise
+        self.manager.changed()
+
+    def __remove(self, paths):
+        ids = []
+        for path in paths:
+            q = self.session.query(Book.id).filter(under(Book.path, path))
+            ids.extend(id_ for id_, in q)
+            self.session.execute(BookFile.__table__.delete().\
+                        where(under(BookFile.path, path)))
+        self.__deletebooks(ids)
+
+    def move(self, old, new):
+        """Change paths of books and states of file or directory
+        renamed from old to new, books are not parsed again."""
+        try:
+            # Renamed file replaces existing one
+            self.__remove([new])
+            for table in (Book.__table__, BookFile.__table__):
+                q = self.session.query(table.c.id, table.c.path).\
+                        filter(under(table.c.path, old))
+                rows = [{"row_id": id_, "newpath": new + path[len(old):]}
+                        for id_, path in q]
+                if rows:
+                    self.session.execute(table.update().\
+                            where(table.c.id == bindparam("row_id")).\
+                            values(path=bindparam("newpath")), rows)
+            self.session.commit()
+        except:
+            self.session.rollback()
+            raise
+        self.manager.changed()
+
     def run(self, path=None):
         """Register path"""
         if path:
             self.path = path
-        self.walk()
+        if self.bulk is None:
+            self.__run()
+            return
+        engine = self.manager.engine
+        with self.manager.profile(self.bulk):
+            dropped = migrate.dropindexes(engine)
+            try:
+                self.__run()
+            finally:
+                migrate.createindexes(engine, dropped)
+                migrate.analyze(engine)
+
+    def __run(self):
+        if self.incremental:
+            with self.timer('loadstates'):
+                self.loadstates()
+        if self.journal is not None:
+            self.journal.start()
+        try:
+            try:
+                self.walk()
+            finally:
+                self.flush()
+            if self.incremental:
+                if self.metrics is not None:
+                    self.metrics.count('deleted', len(self.known))
+                with self.timer('prune'):
+                    self.prune(self.known)
+        except:
+            if self.journal is not None:
+                self.journal.close()
+            raise
+        if self.journal is not None:
+            self.journal.finish()
+        self.known = None
+        self.changed.clear()
+        self.states.clear()
+        self.handled = None
 
 
 class BookInfo(dict):
@@ -118,99 +746,94 @@ class BookInfo(dict):
     def __xml_to_dict(self, file, path):
         """Take information from raw fb2 file."""
         self.path = path
-        ns = {'n':'http://www.gribuser.ru/xml/fictionbook/2.0'}
-        
-        tree = etree.parse(file)
-        root = tree.getroot()
+        info = fb2header(file)
         #Title
-        self.title = tree.xpath('//n:book-title',
-                                namespaces=ns)[0].text
+        self.title = FB2_TITLE(info)[0].text
         #Genres
-        try:
-            genre_list = tree.xpath('//n:genre',
-                                    namespaces=ns)
-        except:
-            genre_list = []
-        self.genres = []
-        for element in genre_list:
-            self.genres.append(element.text)
-
+        self.genres = [element.text for element in FB2_GENRES(info)]
         #lang
-        try:
-            self.lang = tree.xpath('//n:title-info/n:lang',
-                                    namespaces=ns)[0].text
-        except:
-            self.lang = 'ru'
+        lang = FB2_LANG(info)
+        self.lang = lang[0].text if lang else 'ru'
         #Author
         self.authors = []
-        auth_list =  tree.xpath('//n:title-info/n:author',
-                                namespaces=ns)
-        for element in auth_list:
+        for element in FB2_AUTHORS(info):
             d = {}
-            d["firstname"] = element.xpath('//n:first-name',
-                                namespaces=ns)[0].text
-            d["lastname"] = element.xpath('//n:last-name',
-                                namespaces=ns)[0].text
+            name = FB2_FIRSTNAME(element)
+            d["firstname"] = name[0].text if name else None
+            d["lastname"] = FB2_LASTNAME(element)[0].text
             self.authors.append(d)
         return self
 
-    def __fromfb2(self, fname):
-        return self.__xml_to_dict(fname, fname)
-
-    def __fromfb2zip(self, fname):
-        with ZipReader(fname) as reader:
-            error = reader.testzip()
-            if error:
-                raise InvalidZipFile(zipname, error)
-            for name in reader.namelist():
-                if name.endswith('.fb2'):
-                    datafile = reader.read(name)
-        return self.__xml_to_dict(datafile, fname)
-
-    def __fromepub(self, fname):
-        with ZipReader(fname) as reader:
-            error = reader.testzip()
-            if error:
-                raise InvalidZipFile(zipname, error)
-            datafile = reader.read('META-INF/container.xml')
-            tree = etree.parse(datafile)
-            root = tree.getroot()
-            ns = {'ns':'http://www.idpf.org/2007/opf',
-                  'dc':'http://purl.org/dc/elements/1.1/',
-                  'n':'urn:oasis:names:tc:opendocument:xmlns:container',
-                  'xsi':"http://www.w3.org/2001/XMLSchema-instance"}
-            fullpath = tree.xpath('//n:rootfile',namespaces=ns)[0].get('full-path')
-            datafile = reader.read(fullpath)
-            tree = etree.parse(datafile)
-            root = tree.getroot()
-            self.title = tree.xpath('//dc:title',namespaces=ns)[0].text
-            author =tree.xpath('//dc:creator',namespaces=ns)[0].text
-            try:
-                firstname, lastname = author.split()
-            except ValueError:
-                firstname, lastname = author, author
+    def __fromfb2(self, fname, data=None):
+        return self.__xml_to_dict(source(fname, data), fname)
+
+    def __fromfb2zip(self, fname, verify=False, data=None):
+        books = self.fromfb2zip(fname, verify, data)
+        self.update(books[0])
+        return self
+
+    @staticmethod
+    def fromfb2zip(fname, verify=False, data=None):
+        """Return list with information of every fb2 book in archive.
+        Members are decompressed only until header of book is read.
+        verify - check CRC of all files in archive before;
+        data - content of archive if it is already read."""
+        books = []
+        with ZipReader(source(fname, data)) as reader:
+            if verify:
+                error = reader.testzip()
+                if error:
+                    raise InvalidZipFile(fname, error)
+            names = [name for name in reader.namelist()
+                     if name.endswith('.fb2')]
+            for name in names:
+                if len(names) == 1:
+                    path = fname
+                else:
+                    path = '/'.join((fname, name))
+                with reader.open_member(name) as datafile:
+                    books.append(BookInfo().__xml_to_dict(datafile, path))
+        if not books:
+            raise InvalidBookFile("No fb2 book in archive")
+        return books
+
+    def __fromepub(self, fname, verify=False, data=None):
+        """Read only container.xml and OPF file."""
+        with ZipReader(source(fname, data)) as reader:
+            if verify:
+                error = reader.testzip()
+                if error:
+                    raise InvalidZipFile(fname, error)
+            with reader.open_member('META-INF/container.xml') as datafile:
+                tree = etree.parse(datafile)
+            fullpath = EPUB_ROOTFILE(tree)[0].get('full-path')
+            with reader.open_member(fullpath) as datafile:
+                tree = etree.parse(datafile)
+            self.title = EPUB_TITLE(tree)[0].text
+            author = EPUB_CREATOR(tree)[0].text
+            lastname, firstname, middlename = names.parse(author)
             self.authors = []
             d = {}
             d["firstname"] = firstname
             d["lastname"] = lastname
             self.authors.append(d)
-            self.lang = tree.xpath('//dc:language',namespaces=ns)[0].text
-            genre_list = tree.xpath('//dc:subject',namespaces=ns)
-            self.genres = []
-            for element in genre_list:
-              self.genres.append(element.text)
+            self.lang = EPUB_LANG(tree)[0].text
+            self.genres = [element.text for element in EPUB_SUBJECTS(tree)]
             self.path = fname
         return self
 
-    def parsefile(self, filename):
+    def parsefile(self, filename, verify=False, data=None):
         """Return None if ebook type is unknown
-           or book information"""
+           or book information.
+           For fb2 archive with several books only first of them
+           is returned, use parsebooks to get all books of file.
+           data - content of file if it is already read."""
         if filename.endswith(".fb2"):
-            return self.__fromfb2(filename)
+            return self.__fromfb2(filename, data)
         elif filename.endswith(".fb2.zip"):
-            return self.__fromfb2zip(filename)
+            return self.__fromfb2zip(filename, verify, data)
         elif filename.endswith(".epub"):
-            return self.__fromepub(filename)
+            return self.__fromepub(filename, verify, data)
         else:
             return None
 
@@ -223,6 +846,21 @@ def main():
                         help="database path for sqlite")
     parser.add_argument("-c", "--sqlcommand",
                         help="raw sql command for connect to database")
+    parser.add_argument("-j", "--jobs", type=int, default=1,
+                        help="number of worker processes for parsing")
+    parser.add_argument("--maxqueue", type=int,
+                        help="max number of parsed files waiting for database")
+    parser.add_argument("-b", "--batchsize", type=int, default=BATCHSIZE,
+                        help="number of books saved in one transaction")
+    parser.add_argument("-u", "--incremental", action="store_true",
+                        help="index only new or changed files")
+    parser.add_argument("--hash", action="store_true",
+                        help="detect changed files by content hash")
+    parser.add_argument("--verify", action="store_true",
+                        help="check CRC of whole archives while indexing")
+    parser.add_argument("--bulk", action="store_true",
+                        help="fast initial load: drop secondary indexes"
+                             " and sync less while indexing")
     args = parser.parse_args()
     if args.dbase:
         command = 'sqlite:///{}'.format(args.dbase)
@@ -235,7 +873,12 @@ def main():
     FORMAT = '%(levelname)s - %(message)s'
     logging.basicConfig(format=FORMAT)
     logger = logging.getLogger('Crawler.py')
-    cm = CrawlerManager(manager, logger=logger)
+    cm = CrawlerManager(manager, logger=logger,
+                        jobs=args.jobs, maxqueue=args.maxqueue,
+                        batchsize=args.batchsize,
+                        incremental=args.incremental, hashing=args.hash,
+                        verify=args.verify,
+                        bulk=PROFILES['bulk'] if args.bulk else None)
     cm.run(args.path)
 
 if __name__ == '__main__':
@@ -0,0 +1,290 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import os
+import zlib
+import hashlib
+import zipfile
+import logging
+from functools import partial
+from itertools import groupby
+from contextlib import contextmanager
+from collections import defaultdict
+from elib.models import Book, Author, Duplicate, author_books
+from elib.pool import imap
+from elib import names
+
+__doc__ = """Detection of duplicate books: same content in different
+files (fb2 and fb2.zip, copies under other paths) and same title
+and authors. Content is compared by uncompressed size first,
+then by hash of its beginning, whole content is hashed only
+for books still equal, so most files are never read.
+
+Example:
+    dedup = Deduplicator(manager, jobs=4)
+    dedup.find()
+    for group in dedup.groups():
+        print(group)
+    dedup.clean()"""
+
+# Bytes of content hashed by partial hash
+PARTIAL = 64 << 10
+CHUNKSIZE = 1 << 20
+# Order of preference of kept copy: archive, epub, plain fb2
+PREFERENCE = ('.fb2.zip', '.epub', '.fb2')
+
+def split(path):
+    """Return tuple (filename, member) for book path:
+    member is name of book in archive with several books
+    or None if book is whole file."""
+    filename, member = path, None
+    while not os.path.isfile(filename):
+        filename, sep, name = filename.rpartition('/')
+        if not sep:
+            raise FileNotFoundError(path)
+        member = name if member is None else '/'.join((name, member))
+    return filename, member
+
+@contextmanager
+def openpayload(path):
+    """Open content of book for reading. Yield tuple
+    (file object, size): fb2 of archive is decompressed,
+    other files are read as they are."""
+    filename, member = split(path)
+    if member is None and not filename.endswith('.fb2.zip'):
+        with open(filename, 'rb') as f:
+            yield f, os.fstat(f.fileno()).st_size
+        return
+    with zipfile.ZipFile(filename) as z:
+        if member is None:
+            books = [name for name in z.namelist() if name.endswith('.fb2')]
+            if not books:
+                raise KeyError("No fb2 book in archive")
+            member = books[0]
+        info = z.getinfo(member)
+        with z.open(info) as f:
+            yield f, info.file_size
+
+def payloadsize(path):
+    """Uncompressed size of book content or None if it is unreadable.
+    Archives are not decompressed. Module level function,
+    so it may run in worker process."""
+    try:
+        with openpayload(path) as (f, size):
+            return size
+    except (OSError, KeyError, zipfile.BadZipFile):
+        return None
+
+def payloadhash(path, limit=None):
+    """SHA-1 of first limit bytes of book content (all if limit
+    is None) or None if it is unreadable."""
+    h = hashlib.sha1()
+    try:
+        with openpayload(path) as (f, size):
+            left = size if limit is None else min(limit, size)
+            while left > 0:
+                data = f.read(min(CHUNKSIZE, left))
+                if not data:
+                    break
+                h.update(data)
+                left -= len(data)
+    except (OSError, KeyError, zipfile.BadZipFile, zlib.error):
+        return None
+    return h.hexdigest()
+
+def rank(path):
+    """Sort key of copies: preferred one to keep is first.
+    Book inside archive with other books can not be removed,
+    it is always kept."""
+    try:
+        member = split(path)[1]
+    except FileNotFoundError:
+        return (len(PREFERENCE) + 1, path)
+    if member is not None:
+        return (-1, path)
+    for i, ext in enumerate(PREFERENCE):
+        if path.endswith(ext):
+            return (i, path)
+    return (len(PREFERENCE), path)
+
+def refine(buckets, func, jobs=1):
+    """Split every bucket (list of (id, path)) by func(path).
+    Return list of tuples (value, bucket) with at least two books,
+    books for which func returns None are dropped."""
+    items = [(n, book) for n, bucket in enumerate(buckets)
+             for book in bucket]
+    groups = defaultdict(list)
+    values = imap(func, [path for n, (id_, path) in items], jobs)
+    for (n, book), value in zip(items, values):
+        if value is not None:
+            groups[(n, value)].append(book)
+    return [(value, bucket) for (n, value), bucket in groups.items()
+            if len(bucket) > 1]
+
+
+class Deduplicator:
+    """Finds duplicate books in database and saves them
+    to table duplicates, removes redundant copies.
+    jobs - number of worker processes for reading files;
+    partial - bytes of content compared before whole content."""
+    def __init__(self, manager, logger=None, jobs=1, partial=PARTIAL):
+        self.manager = manager
+        self.logger = logger or logging.getLogger(__name__)
+        self.jobs = jobs
+        self.partial = partial
+
+    @property
+    def session(self):
+        """Session of current thread."""
+        return self.manager.getsession()
+
+    def content(self, books):
+        """Groups of books (list of (id, path)) with same content.
+        Return list of tuples (size, hash, books)."""
+        sizes = defaultdict(list)
+        values = imap(payloadsize, [path for id_, path in books], self.jobs)
+        for book, size in zip(books, values):
+            if size is not None:
+                sizes[size].append(book)
+        buckets = [(size, bucket) for size, bucket in sizes.items()
+                   if len(bucket) > 1]
+        self.logger.info("{} books in {} buckets of same size".format(
+                         sum(len(b) for s, b in buckets), len(buckets)))
+        # Small books are hashed whole at once
+        small = [bucket for size, bucket in buckets if size <= self.partial]
+        large = [bucket for size, bucket in buckets if size > self.partial]
+        groups = refine(small, payloadhash, self.jobs)
+        candidates = [bucket for value, bucket in
+                      refine(large, partial(payloadhash, limit=self.partial),
+                             self.jobs)]
+        self.logger.info("{} large books left after partial hash".format(
+                         sum(len(b) for b in candidates)))
+        groups += refine(candidates, payloadhash, self.jobs)
+        size = dict((book, s) for s, bucket in buckets for book in bucket)
+        return [(size[bucket[0]], hash_, sorted(bucket, key=lambda b:
+                                                rank(b[1])))
+                for hash_, bucket in groups]
+
+    def metadata(self):
+        """Groups of books with same normalized title and
+        set of authors. Return list of lists of (id, path)."""
+        books = {}
+        for id_, title, path in self.session.query(Book.id, Book.title,
+                                                   Book.path):
+            books[id_] = (names.fold(title), set(), path)
+        q = self.session.query(author_books.c.book_id,
+                               Author.lastname, Author.firstname).\
+                join(Author, Author.id == author_books.c.author_id)
+        for id_, lastname, firstname in q:
+            if id_ in books:
+                books[id_][1].add(names.key(lastname, firstname))
+        groups = defaultdict(list)
+        for id_, (title, authors, path) in books.items():
+            groups[(title, frozenset(authors))].append((id_, path))
+        return [sorted(bucket, key=lambda b: rank(b[1]))
+                for bucket in groups.values() if len(bucket) > 1]
+
+    def find(self):
+        """Find duplicates of all books and save them,
+        results of previous search are replaced.
+        Return tuple (content groups, metadata groups)."""
+        books = self.session.query(Book.id, Book.path).\
+                    order_by(Book.path).all()
+        content = self.content([tuple(book) for book in books])
+        # Same content means same metadata too
+        same = set(frozenset(id_ for id_, path in bucket)
+                   for size, hash_, bucket in content)
+        metadata = []
+        for bucket in self.metadata():
+            ids = set(id_ for id_, path in bucket)
+            if not any(ids <= group for group in same):
+                metadata.append(bucket)
+        table = Duplicate.__table__
+        rows = []
+        group = 0
+        for size, hash_, bucket in content:
+            group += 1
+            rows.extend({"group_id": group, "book_id": id_,
+                         "kind": "content", "size": size, "hash": hash_}
+                        for id_, path in bucket)
+        for bucket in metadata:
+            group += 1
+            rows.extend({"group_id": group, "book_id": id_,
+                         "kind": "metadata", "size": None, "hash": None}
+                        for id_, path in bucket)
+        try:
+            self.session.execute(table.delete())
+            if rows:
+                self.session.execute(table.insert(), rows)
+            self.session.commit()
+        except:
+            self.session.rollback()
+            raise
+        self.logger.info("Found {} groups of same content and {} of same"
+                         " title and authors".format(len(content),
+                                                     len(metadata)))
+        return len(content), len(metadata)
+
+    def groups(self, kind=None):
+        """Yield saved groups as tuples (group id, kind, size, hash,
+        list of books paths), preferred copy is first."""
+        q = self.session.query(Duplicate.group_id, Duplicate.kind,
+                               Duplicate.size, Duplicate.hash, Book.path).\
+                join(Book, Book.id == Duplicate.book_id).\
+                order_by(Duplicate.group_id)
+        if kind is not None:
+            q = q.filter(Duplicate.kind == kind)
+        for group_id, rows in groupby(q, key=lambda row: row[0]):
+            rows = list(rows)
+            # Other books of group may be deleted
+            if len(rows) > 1:
+                group_id, kind_, size, hash_, path = rows[0]
+                yield (group_id, kind_, size, hash_,
+                       sorted((row[4] for row in rows), key=rank))
+
+    def report(self):
+        """Lines of report of saved duplicates."""
+        lines = []
+        for group_id, kind, size, hash_, paths in self.groups():
+            if kind == 'content':
+                lines.append("Group {}: same content, {} bytes, sha1 {}".\
+                             format(group_id, size, hash_))
+            else:
+                lines.append("Group {}: same title and authors".\
+                             format(group_id))
+            lines.append("  * {}".format(paths[0]))
+            lines.extend("    {}".format(path) for path in paths[1:])
+        return lines
+
+    def clean(self, dryrun=False):
+        """Delete redundant files of books with same content,
+        preferred copy of every group is kept. Books in archives
+        with other books are not touched. Content of file
+        is checked again before it is deleted.
+        Return list of removed (or to be removed for dryrun) files."""
+        from elib.crawler import CrawlerManager
+        removed = []
+        for group_id, kind, size, hash_, paths in \
+                list(self.groups('content')):
+            keep = paths[0]
+            if payloadhash(keep) != hash_:
+                self.logger.warning("{} is changed, group {} skipped".\
+                                    format(keep, group_id))
+                continue
+            for path in paths[1:]:
+                if rank(path)[0] < 0:
+                    continue
+                if payloadhash(path) != hash_:
+                    self.logger.warning("{} is changed, not removed".\
+                                        format(path))
+                    continue
+                if not dryrun:
+                    try:
+                        os.remove(path)
+                    except OSError as e:
+                        self.logger.warning(e)
+                        continue
+                removed.append(path)
+        if removed and not dryrun:
+            cm = CrawlerManager(self.manager, logger=self.logger)
+            cm.remove(removed)
+        return removed
@@ -1,135 +1,115 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
-from elib.manager import BookManager
-from elib.models import Book, Author, Genre
-from sqlalchemy.orm.exc import NoResultFound
 from elib.config import Config
+from elib.metrics import Metrics, profile
+from elib.progress import Progress, precount
 import argparse
 import os
+import sys
 import logging
+import logging.config
 
 __version__ = '0.1.1'
-__doc__ = """Main module of library package."""
+__doc__ = """Main module of library package.
+Database modules are imported when they are needed,
+so zipping and testing start fast."""
 
-class Counterman:
-    """Сlass extends the functionality of BookManager.
-    Counterman could inherit from the BookManager, but you can
-    use one object manager, instead of creating a variety of others."""
+# Names moved to elib.counterman
+COUNTERMAN = ('Counterman', 'Page', 'after', 'authorsline',
+              'LOADERS', 'SORTKEYS', 'PAGESIZE')
 
-    def __init__(self, manager):
-        self.manager = manager
-        self.session = manager.getsession()
+def __getattr__(name):
+    if name in COUNTERMAN:
+        import elib.counterman
+        return getattr(elib.counterman, name)
+    raise AttributeError("module {!r} has no attribute {!r}".\
+                         format(__name__, name))
 
-    #Authors
-    def get_all_authors(self):
-        """All Authors"""
-        return self.session.query(Author).\
-                order_by(Author.lastname).all()
 
-    def get_author_by_id(self, id_):
-        """Get author by id"""
-        return self.session.query(Author).\
-                filter(Author.id == id_).one()
-
-    def get_authors_by_name(self, lastname, firstname=None):
-        """Get authors by name (lastname and/or firstname)"""
-        obj = self.session.query(Author).filter(
-                        Author.lastname == lastname)
-        if firstname:
-            obj = obj.filter(Author.firstname == firstname)
-        obj = obj.order_by(Author.lastname)
-        obj = obj.all()
-        return obj
-
-    #Genres
-    def get_all_genres(self):
-        """All Genres"""
-        return self.session.query(Genre).\
-                    order_by(Genre.name).all()
-
-    def get_genre_by_name(self, name):
-        """Get genre by name"""
-        return self.session.query(Genre).\
-                    filter(Genre.name == name).one()
-
-    def get_genre_by_id(self, id_):
-        """Get genre by id"""
-        return self.session.query(Genre).\
-                    filter(Genre.id == id_).one()
-
-    #Books
-    def get_all_books(self):
-        """All Books"""
-        return self.session.query(Book).\
-                    order_by(Book.title).all()
-
-    def get_book_by_id(self, id_):
-        """Get book by id"""
-        return self.session.query(Book).\
-                    filter(Book.id == id_).one()
-
-    def get_books_by_title(self, title):
-        """Get books by title"""
-        return self.session.query(Book).\
-                    filter(Book.title == title).\
-                    order_by(Book.title).all()
-    def get_books_by_lang(self, lang):
-        """Get books by language"""
-        return self.session.query(Book).\
-                    filter(Book.lang == lang).\
-                    order_by(Book.title).all()
-    def get_books_by_author_id(self, id_):
-        """Get books by author id"""
-        return self.session.query(Book).\
-                    filter(Book.authors.any(id=id_)).\
-                    order_by(Book.title).all()
-
-    def get_books_by_genre(self, genre):
-        """Get book by genre name"""
-        return self.session.query(Book).\
-                    filter(Book.genres.any(name=genre)).\
-                    order_by(Book.title).all()
-    def get_book_by_path(self, path):
-        """Get book by path"""
-        return self.session.query(Book).\
-                    filter(Book.path == path).one()
-
-    def info_for_options(self):
-        """Info about class features.
-        For auto create menu."""
-        cls_dict = type(self).__dict__
-        list_ = []
-        n = 1
-        for key in cls_dict.keys():
-            if key.startswith("get"):
-                d = {"func": cls_dict[key],
-                    "doc": cls_dict[key].__doc__,
-                    "fname": key,
-                    }
-                list_.append(d)
-            list_ = sorted(list_, key=lambda x: x["doc"])
-        d = {}
-        for i in list_:
-            d[n] = i
-            n +=1
-        return d
-
-
-def indexing(manager, path, logger=None):
+def indexing(manager, path, logger=None, jobs=1, maxqueue=None,
+             batchsize=None, incremental=False, hashing=False,
+             verify=False, bulk=None, metrics=None, progress=None,
+             ignore=None, prefetch=0, journal=None):
     """Indexing path and add books to database.
-    CrawlerManager using"""
+    CrawlerManager using.
+    jobs - number of worker processes for parsing files;
+    maxqueue - max number of parsed files waiting for database;
+    batchsize - number of books saved in one transaction;
+    incremental - parse only new or changed files, forget deleted;
+    hashing - compare content of files with changed mtime;
+    verify - check CRC of whole archives (slow, see -t);
+    bulk - storage profile for fast initial load;
+    metrics - elib.metrics.Metrics for timings of stages;
+    progress - elib.progress.Progress for reports;
+    ignore - glob patterns of names of directories not walked;
+    prefetch - number of files read ahead of parser;
+    journal - elib.journal.Journal for resuming of interrupted run."""
     import elib.crawler as crawler
-    cm = crawler.CrawlerManager(manager, logger=logger)
+    cm = crawler.CrawlerManager(manager, logger=logger,
+                                jobs=jobs, maxqueue=maxqueue,
+                                batchsize=batchsize or crawler.BATCHSIZE,
+                                incremental=incremental,
+                                hashing=hashing,
+                                verify=verify,
+                                bulk=bulk,
+                                metrics=metrics,
+                                progress=progress,
+                                ignore=ignore,
+                                prefetch=prefetch,
+                                journal=journal)
     if os.path.isdir(path):
         cm.run(path)
+        if progress is not None:
+            progress.finish()
     else:
         cm.addfile(path)
     del cm
 
-def humaninterface(manager):
-    """Human menu console interface"""
+def watching(manager, path, logger=None, batchsize=None, hashing=False,
+             verify=False, ignore=None, delay=None, poll=None):
+    """Index changes of path and keep index up to date
+    until interrupted. Files changed before start are found
+    by incremental indexing.
+    delay - seconds of quiet before changed file is indexed;
+    poll - seconds between scans, directory is polled
+    instead of inotify."""
+    import elib.crawler as crawler
+    import elib.watcher as watcher
+    cm = crawler.CrawlerManager(manager, logger=logger,
+                                batchsize=batchsize or crawler.BATCHSIZE,
+                                incremental=True,
+                                hashing=hashing,
+                                verify=verify,
+                                ignore=ignore)
+    # Changes made while path is indexed are not lost
+    with watcher.changes(path, crawler.EXTENSIONS, ignore,
+                         logger, poll) as source:
+        cm.run(path)
+        watcher.watch(cm, source, delay or watcher.DELAY)
+
+def humaninterface(manager, cache=None):
+    """Human menu console interface
+    cache - QueryCache for repeated queries."""
+    from elib.models import Book, Author, Genre
+    from elib.counterman import Counterman
+    from sqlalchemy.orm.exc import NoResultFound
     print_del = lambda: print("{:-^30}".format('-'))
-    c = Counterman(manager)
+    def printresult(result):
+        print("{:-^30}".format('Result:'))
+        print("{:4s}| {}".format("id", "object"))
+        print_del()
+        if isinstance(result, list):
+            for obj in result:
+                if isinstance(obj, (Book, Author, Genre)):
+                    print("{:4d}: {}".format(obj.id, str(obj)))
+                else:
+                    # Row of Counterman.brief
+                    print("{:4d}: {}: {}".format(obj.id, obj.authors or '',
+                                                 obj.title))
+        else:
+            print("{:4d}: {}".format(result.id, str(result)))
+        print_del()
+    c = Counterman(manager, cache=cache)
     d = c.info_for_options()
     #Create main menu
     lst = []
@@ -151,22 +131,29 @@ def humaninterface(manager):
             if i == 0:
                 break
             foo = d[i]["func"]
+            args = ()
             if "by" in d[i]["fname"]:
                 arg = input("Enter data: ")
                 if "id" in d[i]["fname"]:
                     arg = int(arg)
-                result = foo(c, arg)
-            else:
-                result = foo(c)
-            print("{:-^30}".format('Result:'))
-            print("{:4s}| {}".format("id", "object"))
-            print_del()
-            if type(result) == list:
-                for obj in result:
-                    print("{:4d}: {}".format(obj.id, str(obj)))
+                args = (arg,)
+            # Lists are shown by pages
+            query = getattr(c, "query" + d[i]["fname"][3:], None)
+            if query is not None:
+                query = query(*args)
+                if query.column_descriptions[0]["type"] is Book:
+                    query = c.brief(query)
+                cursor = None
+                while True:
+                    page = c.page(query, cursor=cursor)
+                    printresult(page)
+                    cursor = page.cursor
+                    if cursor is None:
+                        break
+                    if input("Type (m)enu or Enter for next page: ") == "m":
+                        break
             else:
-                print("{:4d}: {}".format(result.id, str(result)))
-            print_del()
+                printresult(foo(c, *args))
             i = input("Type (q) to exit or (n)ext: ")
             if i == "q":
                 break
@@ -177,23 +164,84 @@ def humaninterface(manager):
         except NoResultFound:
             print("No results found")
 
-def zip_(zipper, path, removeoriginal):
+def zip_(zipper, path, removeoriginal, jobs=1, metrics=None,
+         progress=None, ignore=None):
     """Zipping with zipper module.
-    zipper - pre imported module"""
+    zipper - pre imported module;
+    jobs - number of worker processes;
+    metrics - Metrics for timings;
+    progress - Progress for reports;
+    ignore - glob patterns of names of skipped directories."""
     if os.path.isdir(path):
-        zipper.zippath(path,
-                        removeoriginal)
+        summary = zipper.zippath(path, removeoriginal, jobs, metrics,
+                                 progress, ignore)
+        if progress is not None:
+            progress.finish()
+        print(summary)
     else:
         zipper.ziponefile(path,
                         removeoriginal=removeoriginal)
 
-def test_(zipper, path):
+def test_(zipper, path, jobs=1, cache=None, metrics=None, progress=None,
+          ignore=None, prefetch=0):
     """Test with zipper module.
-    zipper - pre imported module"""
+    zipper - pre imported module;
+    jobs - number of worker processes;
+    cache - zipper.TestCache with results of previous tests;
+    metrics - Metrics for timings;
+    progress - Progress for reports;
+    ignore - glob patterns of names of skipped directories;
+    prefetch - number of files read ahead of testing."""
     if os.path.isdir(path):
-        zipper.testpath(path)
+        summary = zipper.testpath(path, jobs=jobs, cache=cache,
+                                  metrics=metrics, progress=progress,
+                                  ignore=ignore, prefetch=prefetch)
+        if progress is not None:
+            progress.finish()
+        print(summary)
     else:
-        zipper.testfile(path)
+        zipper.testfile(path, cache)
+
+def dedup_(manager, logger=None, jobs=1, clean=False, dryrun=False):
+    """Find duplicate books and print report.
+    jobs - number of worker processes for reading files;
+    clean - delete redundant copies of books with same content;
+    dryrun - only print files which clean would delete."""
+    from elib.dedup import Deduplicator
+    dedup = Deduplicator(manager, logger, jobs)
+    dedup.find()
+    for line in dedup.report():
+        print(line)
+    if clean and dryrun:
+        removed = dedup.clean(dryrun=True)
+        for path in removed:
+            print("Would remove {}".format(path))
+        print("Would remove {} duplicate files".format(len(removed)))
+    elif clean:
+        removed = dedup.clean()
+        print("Removed {} duplicate files".format(len(removed)))
+
+def report(metrics, textfile=None):
+    """Print summary of metrics to stderr
+    and write them to Prometheus textfile."""
+    if metrics is None:
+        return
+    print(metrics.summary(), file=sys.stderr)
+    if textfile:
+        metrics.writetextfile(textfile)
+
+def makeprogress(args, name, extensions=None, ignore=None, skip=None):
+    """Progress of work with args.path or None
+    if it is not asked for.
+    extensions, ignore, skip - files walked by work, see precount."""
+    if not args.progress or not args.path or \
+            not os.path.isdir(args.path):
+        return None
+    total = totalbytes = None
+    if args.precount:
+        total, totalbytes = precount(args.path, extensions, ignore, skip)
+    return Progress(total, totalbytes, args.interval,
+                    jsonlines=args.progress == 'json', name=name)
 
 def main():
     parser = argparse.ArgumentParser()
@@ -212,9 +260,89 @@ def main():
     parser.add_argument("-i", "--indexing",
                         action="store_true",
                         help="indexing to database")
+    parser.add_argument("-j", "--jobs", type=int, default=1,
+                        help="number of worker processes for indexing,"
+                             " zipping and testing")
+    parser.add_argument("--maxqueue", type=int,
+                        help="max number of parsed files waiting for database")
+    parser.add_argument("-b", "--batchsize", type=int,
+                        help="number of books saved in one transaction")
+    parser.add_argument("-u", "--incremental",
+                        action="store_true",
+                        help="index only new or changed files")
+    parser.add_argument("--hash",
+                        action="store_true",
+                        help="detect changed files by content hash"
+                             " (indexing and testing)")
+    parser.add_argument("-f", "--force",
+                        action="store_true",
+                        help="test all files again, ignore saved results")
+    parser.add_argument("--verify",
+                        action="store_true",
+                        help="check CRC of whole archives while indexing")
+    parser.add_argument("--bulk",
+                        action="store_true",
+                        help="fast initial indexing: drop secondary indexes"
+                             " and use bulk storage profile")
     parser.add_argument("-r", "--removeoriginal",
                         action="store_true",
                         help="indexing to database")
+    parser.add_argument("-m", "--migrate",
+                        action="store_true",
+                        help="add new tables and indexes to existing database")
+    parser.add_argument("--metrics",
+                        action="store_true",
+                        help="print timings of stages after indexing,"
+                             " zipping or testing")
+    parser.add_argument("--prometheus", metavar="FILE",
+                        help="write metrics to Prometheus textfile")
+    parser.add_argument("--profile", metavar="FILE",
+                        help="profile main process with cProfile,"
+                             " save stats to FILE ('-' prints them)")
+    parser.add_argument("--progress", nargs="?", const="text",
+                        choices=("text", "json"),
+                        help="report progress to stderr as text"
+                             " or JSON lines")
+    parser.add_argument("--precount",
+                        action="store_true",
+                        help="count files first, for ETA in progress")
+    parser.add_argument("--interval", type=float, default=2.0,
+                        help="seconds between progress reports")
+    parser.add_argument("--ignore", metavar="PATTERN", action="append",
+                        default=[],
+                        help="skip directories matching glob pattern"
+                             " (may be repeated)")
+    parser.add_argument("--prefetch", type=int, default=0, metavar="N",
+                        help="read N files ahead of parser in threads"
+                             " (indexing and testing)")
+    parser.add_argument("--resume",
+                        action="store_true",
+                        help="continue interrupted indexing of path,"
+                             " skip files already saved")
+    parser.add_argument("-w", "--watch", metavar="PATH",
+                        help="index changes of PATH as they happen,"
+                             " until interrupted")
+    parser.add_argument("--delay", type=float,
+                        help="seconds without changes of file"
+                             " before it is indexed by --watch")
+    parser.add_argument("--poll", type=float, metavar="SECONDS",
+                        help="poll directory every SECONDS"
+                             " instead of inotify in --watch")
+    parser.add_argument("--merge-authors",
+                        action="store_true",
+                        help="merge authors with variants of one name")
+    parser.add_argument("--dedup",
+                        action="store_true",
+                        help="find duplicate books in database"
+                             " and print them")
+    parser.add_argument("--dedup-clean",
+                        action="store_true",
+                        help="find duplicate books and delete files"
+                             " of redundant copies with same content")
+    parser.add_argument("--dry-run",
+                        action="store_true",
+                        help="with --dedup-clean only print files"
+                             " which would be deleted")
     parser.add_argument("-q", "--quiet",
                         action="store_true",
                         help="quiet mode (not show menu)")
@@ -227,27 +355,89 @@ def main():
         FORMAT = '%(levelname)s - %(message)s'
         logging.basicConfig(format=FORMAT)
     logger = logging.getLogger('elib.py')
+    ignore = conf.getIgnore() + args.ignore
+    metrics = None
+    if args.metrics or args.prometheus:
+        metrics = Metrics()
     try:
-        if args.test or args.zip:
-            import elib.zipper as zz
-            if args.test:
-                test_(zz, args.path, )
-            if args.zip:
-                zip_(zz, args.path, args.removeoriginal)
+        with profile(args.profile):
+            if args.test or args.zip:
+                import elib.zipper as zz
+                if args.test:
+                    with zz.TestCache(conf.getTestCacheName(),
+                                      args.hash, args.force) as cache:
+                        test_(zz, args.path, args.jobs, cache, metrics,
+                              makeprogress(args, 'test', ignore=ignore),
+                              ignore, args.prefetch)
+                if args.zip:
+                    zip_(zz, args.path, args.removeoriginal, args.jobs,
+                         metrics, makeprogress(args, 'zip', ignore=ignore),
+                         ignore)
+                if args.quiet and not (args.indexing or args.migrate or
+                                       args.merge_authors or args.dedup or
+                                       args.dedup_clean or args.watch):
+                    report(metrics, args.prometheus)
+                    return
 
-        command = conf.getSQLCommand()
-        if args.dbase:
-            command = 'sqlite:///{}'.format(args.dbase)
-        elif args.sqlcommand:
-            command = args.sqlcommand
-        m = BookManager(command)
-        with BookManager(command) as manager:
-            if args.indexing:
-                indexing(manager, args.path, logger)
-            if args.quiet:
-                from sys import exit
-                exit()
-            humaninterface(manager)
+            from elib.manager import BookManager
+            command = conf.getSQLCommand()
+            if args.dbase:
+                command = 'sqlite:///{}'.format(args.dbase)
+            elif args.sqlcommand:
+                command = args.sqlcommand
+            m = BookManager(command, pragmas=conf.getProfile(),
+                            **conf.getPoolOptions())
+            with BookManager(command) as manager:
+                if metrics is not None:
+                    manager.instrument(metrics)
+                if args.migrate:
+                    import elib.migrate
+                    created = elib.migrate.upgrade(manager.engine)
+                    print("Created indexes: {}".format(len(created)))
+                if args.merge_authors:
+                    import elib.migrate
+                    merged = elib.migrate.mergevariants(manager.engine)
+                    manager.changed()
+                    print("Merged authors: {}".format(merged))
+                if args.indexing:
+                    from elib.crawler import EXTENSIONS
+                    from elib.journal import Journal
+                    journal = skip = None
+                    if os.path.isdir(args.path):
+                        journal = Journal(
+                                conf.getJournalName(command, args.path),
+                                args.path, args.resume)
+                        # Files committed by interrupted run
+                        skip = journal.done
+                    indexing(manager, args.path, logger,
+                             args.jobs, args.maxqueue,
+                             args.batchsize or conf.getBatchSize(),
+                             args.incremental, args.hash, args.verify,
+                             conf.getProfile('bulk') if args.bulk else None,
+                             metrics, makeprogress(args, 'index',
+                                                   EXTENSIONS, ignore,
+                                                   skip),
+                             ignore, args.prefetch, journal)
+                if args.dedup or args.dedup_clean:
+                    dedup_(manager, logger, args.jobs, args.dedup_clean,
+                           args.dry_run)
+                if args.watch:
+                    try:
+                        watching(manager, args.watch, logger,
+                                 args.batchsize or conf.getBatchSize(),
+                                 args.hash, args.verify, ignore,
+                                 args.delay, args.poll)
+                    finally:
+                        report(metrics, args.prometheus)
+                    return
+                report(metrics, args.prometheus)
+                if args.quiet:
+                    from sys import exit
+                    exit()
+                from elib.cache import QueryCache
+                size, ttl = conf.getQueryCache()
+                humaninterface(manager,
+                               QueryCache(size, ttl) if size else None)
     except KeyboardInterrupt:
         print("Process stopped manually.")
     except Exception as e:
@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import os
+import json
+import time
+import logging
+from elib.scanner import walkkey
+
+__doc__ = """Checkpoint journal of indexing run.
+Files are walked in deterministic order (see scanner.scan), so
+last file of committed batch is enough to skip work done before.
+
+Example:
+    journal = Journal(Config().getJournalName(command, path), path,
+                      resume=True)
+    CrawlerManager(manager, journal=journal).run(path)"""
+
+logger = logging.getLogger(__name__)
+
+class Journal:
+    """JSON lines file: first line describes run,
+    every next one is written after commit of batch.
+    path - walked directory;
+    resume - load checkpoint of interrupted run, files
+    up to it are skipped."""
+    def __init__(self, filename, path, resume=False):
+        self.filename = filename
+        self.path = path
+        self.checkpoint = None
+        self.last = None
+        self.file = None
+        if resume:
+            self.load()
+
+    def load(self):
+        """Read last committed file of previous run."""
+        try:
+            with open(self.filename) as f:
+                lines = [json.loads(line) for line in f if line.strip()]
+        except (OSError, ValueError) as e:
+            logger.info("No checkpoint to resume: {}".format(e))
+            return
+        if not lines or lines[0].get("path") != os.path.abspath(self.path):
+            logger.info("No checkpoint to resume for {}".format(self.path))
+            return
+        for line in reversed(lines[1:]):
+            if "committed" in line:
+                self.last = line["committed"]
+                self.checkpoint = walkkey(self.path, self.last)
+                logger.info("Resume after {}".format(self.last))
+                break
+
+    def start(self):
+        """Open journal for run, old one is kept only if resumed."""
+        directory = os.path.dirname(self.filename)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        if self.checkpoint is not None:
+            self.file = open(self.filename, 'a')
+            self.write({"resumed": self.last, "time": time.time()})
+        else:
+            self.file = open(self.filename, 'w')
+            self.write({"path": os.path.abspath(self.path),
+                        "started": time.time()})
+
+    def write(self, record):
+        self.file.write(json.dumps(record) + "\n")
+        # Lost line costs one batch only, so no fsync
+        self.file.flush()
+
+    def done(self, filename):
+        """True if file was committed before checkpoint."""
+        return self.checkpoint is not None and \
+               walkkey(self.path, filename) <= self.checkpoint
+
+    def commit(self, filename, books):
+        """Record that files up to filename are committed."""
+        if self.file is not None and filename is not None:
+            self.write({"committed": filename, "books": books,
+                        "time": time.time()})
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def finish(self):
+        """Run completed, nothing to resume."""
+        self.close()
+        try:
+            os.remove(self.filename)
+        except OSError:
+            pass
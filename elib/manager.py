@@ -1,52 +1,169 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 from elib.models import Base, Book, Author, Genre
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
+from elib import search
+from sqlalchemy import create_engine, event
+from sqlalchemy.orm import sessionmaker, scoped_session
+from sqlalchemy.pool import QueuePool
+from contextlib import contextmanager
+import threading
+import time
 
 __doc__ = """Use class BookManager for managing 
-database with ebooks collection."""
+database with ebooks collection.
+
+Every thread works with own session:
+    manager = BookManager(command, pool_size=5, max_overflow=10)
+    manager.getsession().query(Book).all()
+    # or commit unit of work in separate session
+    with manager.unitofwork() as session:
+        session.add(book)"""
 
 SQLCOMMAND = 'sqlite:///:memory:'
 
+# PRAGMAs allowed in storage profiles
+PRAGMAS = ('journal_mode', 'synchronous', 'cache_size',
+           'mmap_size', 'temp_store')
+
 def singleton(cls):
     """Singleton takes from PEP-0318.
-    http://www.python.org/dev/peps/pep-0318/#examples"""
+    http://www.python.org/dev/peps/pep-0318/#examples
+    One instance for every database URL."""
     instances = {}
-    def getinstance(*args, **kwargs):
-        if cls not in instances:
-            instances[cls] = cls(*args, **kwargs)
-        return instances[cls]
+    lock = threading.Lock()
+    def getinstance(command=None, *args, **kwargs):
+        key = command or SQLCOMMAND
+        with lock:
+            if key not in instances:
+                instances[key] = cls(key, *args, **kwargs)
+            return instances[key]
     return getinstance
 
 @singleton
 class BookManager:
     """Book Manager provides features of database,
     and hides some trivial operations.
-    Support with statement."""
+    Support with statement.
+    pool_size, max_overflow - connections kept in pool and
+    opened above it (not used for in-memory SQLite);
+    pragmas - storage profile of SQLite (see config.PROFILES),
+    applied to every new connection."""
 
     #def __init__(self, *args, **kwargs):
-    def __init__(self, command=None, echo=False):
+    def __init__(self, command=None, echo=False,
+                 pool_size=None, max_overflow=None, pragmas=None):
         if not command:
             command = SQLCOMMAND
-        self.engine = create_engine(command, echo=echo)
-        Session = sessionmaker(bind=self.engine)
-        self.session = Session()
+        options = {}
+        if (pool_size is not None or max_overflow is not None) \
+                and ':memory:' not in command:
+            options['poolclass'] = QueuePool
+            if pool_size is not None:
+                options['pool_size'] = pool_size
+            if max_overflow is not None:
+                options['max_overflow'] = max_overflow
+            if command.startswith('sqlite'):
+                # Pooled connections are shared between threads
+                options['connect_args'] = {'check_same_thread': False}
+        self.engine = create_engine(command, echo=echo, **options)
+        self.pragmas = {}
+        if self.engine.dialect.name == 'sqlite':
+            self.pragmas = self.__checkpragmas(pragmas or {})
+            event.listen(self.engine, 'connect', self.__connect)
+        self.sessionmaker = sessionmaker(bind=self.engine)
+        # Session of current thread
+        self.Session = scoped_session(self.sessionmaker)
         Base.metadata.create_all(self.engine)
+        search.create(self.engine)
+        # Changed by writers, readers drop cached results
+        self.version = 0
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def __checkpragmas(pragmas):
+        for name in pragmas:
+            if name not in PRAGMAS:
+                raise ValueError("Unknown PRAGMA: {}".format(name))
+        return dict(pragmas)
+
+    def __connect(self, dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for name, value in self.pragmas.items():
+            cursor.execute("PRAGMA {} = {}".format(name, value))
+        cursor.close()
+
+    @contextmanager
+    def profile(self, pragmas):
+        """Use other storage profile inside with block.
+        Pooled connections are closed, so new ones get it."""
+        if self.engine.dialect.name != 'sqlite':
+            yield
+            return
+        old = self.pragmas
+        memory = self.engine.url.database in (None, '', ':memory:')
+        self.closesession()
+        self.pragmas = self.__checkpragmas(pragmas)
+        if not memory:
+            self.engine.dispose()
+        try:
+            yield
+        finally:
+            self.closesession()
+            self.pragmas = old
+            if not memory:
+                self.engine.dispose()
+
+    def instrument(self, metrics):
+        """Time SQL statements in metrics (elib.metrics.Metrics),
+        stage sql labelled by kind of statement."""
+        def before(conn, cursor, statement, parameters, context, many):
+            conn.info.setdefault('elib_start', []).\
+                    append(time.perf_counter())
+        def after(conn, cursor, statement, parameters, context, many):
+            start = conn.info['elib_start'].pop()
+            kind = statement.lstrip().split(None, 1)[0].lower()
+            metrics.observe('sql', time.perf_counter() - start,
+                            statement=kind)
+            if cursor.rowcount > 0:
+                metrics.count('rows', cursor.rowcount, statement=kind)
+        event.listen(self.engine, 'before_cursor_execute', before)
+        event.listen(self.engine, 'after_cursor_execute', after)
+
+    def changed(self):
+        """Mark catalog as changed."""
+        with self.lock:
+            self.version += 1
+
+    @property
+    def session(self):
+        return self.Session()
 
-    # Nearest code for work with session object
-    # valid only for single-thread version.
     def getsession(self):
-        return self.session
+        """Session of current thread."""
+        return self.Session()
+
+    @contextmanager
+    def unitofwork(self):
+        """New session, committed if block succeeds
+        and rolled back otherwise."""
+        session = self.sessionmaker()
+        try:
+            yield session
+            session.commit()
+        except:
+            session.rollback()
+            raise
+        finally:
+            session.close()
 
     def closesession(self):
-        """Close current session.
+        """Close session of current thread.
         Also it must be called in with statement realisation."""
-        if self.session:
-            self.session.close()
+        self.Session.remove()
 
     def __del__(self):
-        self.closesession()
+        if hasattr(self, "Session"):
+            self.closesession()
 
     #For with statement
     def __enter__(self):
@@ -56,4 +173,4 @@ class BookManager:
         if exc_type is None:
             self.session.commit()
         if hasattr(self, "closesession"):
-            self.closesession()
\ No newline at end of file
+            self.closesession()
@@ -0,0 +1,190 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import os
+import sys
+import time
+import tempfile
+from bisect import bisect_left
+from contextlib import contextmanager
+
+__doc__ = """Counters and timing histograms of indexing, zipping
+and database work, by stage and type of file.
+
+Example:
+    metrics = Metrics()
+    CrawlerManager(manager, metrics=metrics).run(path)
+    print(metrics.summary())
+    metrics.writetextfile('/var/lib/node_exporter/elib.prom')"""
+
+# Upper bounds of histogram buckets in seconds
+BUCKETS = (0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0)
+PREFIX = 'elib'
+
+def filetype(filename):
+    """Type of file for labels: fb2, fb2.zip, epub, zip or other."""
+    for ext in ('.fb2.zip', '.fb2', '.epub', '.zip'):
+        if filename.endswith(ext):
+            return ext[1:]
+    return 'other'
+
+def timed(func, item, **kwargs):
+    """Return tuple (func(item, **kwargs), seconds).
+    Module level function, so it may run in worker process."""
+    start = time.perf_counter()
+    result = func(item, **kwargs)
+    return result, time.perf_counter() - start
+
+
+class Histogram:
+    """Timings of one stage."""
+    def __init__(self):
+        self.buckets = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds):
+        self.buckets[bisect_left(BUCKETS, seconds)] += 1
+        self.count += 1
+        self.sum += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+
+class Metrics:
+    """Registry of counters and histograms.
+    Labels are keyword arguments, for example type='fb2'."""
+    def __init__(self):
+        self.counters = {}
+        self.histograms = {}
+
+    @staticmethod
+    def key(name, labels):
+        return name, tuple(sorted(labels.items()))
+
+    def count(self, name, n=1, **labels):
+        key = self.key(name, labels)
+        self.counters[key] = self.counters.get(key, 0) + n
+
+    def observe(self, stage, seconds, **labels):
+        key = self.key(stage, labels)
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            histogram = self.histograms[key] = Histogram()
+        histogram.observe(seconds)
+
+    @contextmanager
+    def timer(self, stage, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - start, **labels)
+
+    def timeiter(self, stage, iterable, **labels):
+        """Yield items of iterable, time of getting them
+        is observed as stage."""
+        it = iter(iterable)
+        while True:
+            start = time.perf_counter()
+            try:
+                item = next(it)
+            except StopIteration:
+                self.observe(stage, time.perf_counter() - start, **labels)
+                return
+            self.observe(stage, time.perf_counter() - start, **labels)
+            yield item
+
+    def summary(self):
+        """Table of stages and counters."""
+        lines = ["{:<10}{:<36}{:>9}{:>11}{:>10}{:>10}".format(
+                    "stage", "labels", "count", "total s",
+                    "mean ms", "max ms")]
+        for (stage, labels), h in sorted(self.histograms.items()):
+            lines.append("{:<10}{:<36}{:>9}{:>11.3f}{:>10.3f}{:>10.3f}".\
+                format(stage, labelstr(labels), h.count, h.sum,
+                       1000 * h.sum / h.count if h.count else 0,
+                       1000 * h.max))
+        if self.counters:
+            lines.append("")
+            lines.append("{:<10}{:<36}{:>9}".format(
+                            "counter", "labels", "value"))
+            for (name, labels), value in sorted(self.counters.items()):
+                lines.append("{:<10}{:<36}{:>9}".format(
+                                name, labelstr(labels), value))
+        return "\n".join(lines)
+
+    def prometheus(self):
+        """Metrics in Prometheus text format."""
+        lines = []
+        for name in sorted(set(k[0] for k in self.counters)):
+            metric = "{}_{}_total".format(PREFIX, name)
+            lines.append("# TYPE {} counter".format(metric))
+            for (n, labels), value in sorted(self.counters.items()):
+                if n == name:
+                    lines.append("{}{} {}".format(
+                                    metric, promlabels(labels), value))
+        for stage in sorted(set(k[0] for k in self.histograms)):
+            metric = "{}_{}_seconds".format(PREFIX, stage)
+            lines.append("# TYPE {} histogram".format(metric))
+            for (n, labels), h in sorted(self.histograms.items()):
+                if n != stage:
+                    continue
+                total = 0
+                for bound, value in zip(BUCKETS + ('+Inf',), h.buckets):
+                    total += value
+                    lines.append("{}_bucket{} {}".format(metric,
+                            promlabels(labels + (('le', str(bound)),)),
+                            total))
+                lines.append("{}_sum{} {}".format(
+                                metric, promlabels(labels), h.sum))
+                lines.append("{}_count{} {}".format(
+                                metric, promlabels(labels), h.count))
+        return "\n".join(lines) + "\n"
+
+    def writetextfile(self, filename):
+        """Write Prometheus textfile atomically,
+        so collector never reads half-written file."""
+        directory = os.path.dirname(os.path.abspath(filename))
+        fd, tmpname = tempfile.mkstemp(prefix='.', suffix='.tmp',
+                                       dir=directory)
+        try:
+            with os.fdopen(fd, 'w') as f:
+                f.write(self.prometheus())
+            os.chmod(tmpname, 0o644)
+            os.replace(tmpname, filename)
+        except:
+            os.remove(tmpname)
+            raise
+
+
+def labelstr(labels):
+    return ",".join("{}={}".format(k, v) for k, v in labels)
+
+def promlabels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join('{}="{}"'.format(k, str(v).replace('\\', '\\\\').\
+                                            replace('"', '\\"'))
+                          for k, v in labels) + "}"
+
+@contextmanager
+def profile(filename=None):
+    """Profile with block by cProfile if filename is given,
+    stats are saved to filename ('-' prints them to stderr)."""
+    if not filename:
+        yield
+        return
+    import cProfile
+    import pstats
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        if filename == '-':
+            pstats.Stats(profiler, stream=sys.stderr).\
+                sort_stats('cumulative').print_stats(30)
+        else:
+            profiler.dump_stats(filename)
@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+from elib.models import Base, Author, author_books
+from elib import search, names
+from sqlalchemy import inspect, text, select, func, and_
+import logging
+
+__doc__ = """Upgrade existing database to current models:
+create new tables and missing indexes.
+
+Example:
+    manager = BookManager(command)
+    upgrade(manager.engine)"""
+
+logger = logging.getLogger(__name__)
+
+def mergeauthors(connection, key=None):
+    """Merge authors with same name, so unique index may be created.
+    Books of duplicates are moved to author with smallest id.
+    key - function of (lastname, firstname) which is same
+    for one author (by default name itself).
+    Return number of removed authors."""
+    authors = Author.__table__
+    first = {}
+    merged = 0
+    q = select([authors.c.id, authors.c.lastname, authors.c.firstname]).\
+            order_by(authors.c.id)
+    for id_, lastname, firstname in connection.execute(q).fetchall():
+        k = (lastname, firstname) if key is None else \
+            key(lastname, firstname)
+        if k not in first:
+            first[k] = id_
+            continue
+        connection.execute(author_books.update().\
+                where(author_books.c.author_id == id_).\
+                values(author_id=first[k]))
+        connection.execute(authors.delete().where(authors.c.id == id_))
+        merged += 1
+    if merged:
+        # Book may get same author twice
+        q = select([author_books.c.book_id, author_books.c.author_id]).\
+                group_by(author_books.c.book_id, author_books.c.author_id).\
+                having(func.count() > 1)
+        for book_id, author_id in connection.execute(q).fetchall():
+            connection.execute(author_books.delete().where(and_(
+                        author_books.c.book_id == book_id,
+                        author_books.c.author_id == author_id)))
+            connection.execute(author_books.insert().values(
+                        book_id=book_id, author_id=author_id))
+    return merged
+
+def mergevariants(engine):
+    """Merge authors with variants of one name (see names.key):
+    different case, ё/е, middle names or swapped names.
+    Return number of removed authors."""
+    fts = search.exists(engine)
+    with engine.begin() as connection:
+        merged = mergeauthors(connection, names.key)
+        if merged and fts:
+            # Books of merged authors are found by saved names
+            search.rebuild(connection)
+    if merged:
+        logger.info("Merged {} variants of authors names".format(merged))
+    return merged
+
+def secondary(table):
+    """Indexes of table which may be dropped for bulk load:
+    not unique ones."""
+    return [index for index in sorted(table.indexes, key=lambda x: x.name)
+            if not index.unique]
+
+def dropindexes(engine):
+    """Drop existing secondary indexes.
+    Return list of dropped Index objects."""
+    dropped = []
+    with engine.begin() as connection:
+        inspector = inspect(connection)
+        for table in Base.metadata.sorted_tables:
+            exist = set(index["name"] for index in
+                        inspector.get_indexes(table.name))
+            for index in secondary(table):
+                if index.name in exist:
+                    index.drop(connection)
+                    dropped.append(index)
+    return dropped
+
+def createindexes(engine, indexes):
+    """Create indexes dropped by dropindexes."""
+    with engine.begin() as connection:
+        for index in indexes:
+            index.create(connection)
+
+def analyze(engine):
+    """Collect statistics for query planner."""
+    if engine.dialect.name == "sqlite":
+        with engine.begin() as connection:
+            connection.execute(text("ANALYZE"))
+
+def upgrade(engine):
+    """Create missing tables and indexes,
+    fill full-text index for books indexed before it.
+    Return list of names of created indexes."""
+    Base.metadata.create_all(engine)
+    created = []
+    with engine.begin() as connection:
+        inspector = inspect(connection)
+        for table in Base.metadata.sorted_tables:
+            exist = set(index["name"] for index in
+                        inspector.get_indexes(table.name))
+            for index in sorted(table.indexes, key=lambda x: x.name):
+                if index.name in exist:
+                    continue
+                if index.unique and table.name == "authors":
+                    n = mergeauthors(connection)
+                    if n:
+                        logger.info("Merged {} duplicate authors".format(n))
+                index.create(connection)
+                created.append(index.name)
+                logger.info("Created index {}".format(index.name))
+    if search.create(engine):
+        with engine.begin() as connection:
+            # Books indexed before full-text search was added
+            n = connection.execute(text("SELECT "
+                "(SELECT COUNT(*) FROM books) - "
+                "(SELECT COUNT(*) FROM {})".format(search.TABLE))).scalar()
+            if n:
+                search.rebuild(connection)
+                logger.info("Rebuilt full-text index")
+    analyze(engine)
+    return created
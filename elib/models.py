@@ -1,7 +1,7 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy import Column, Integer, String
+from sqlalchemy import Column, Integer, String, Float, Index
 
 from sqlalchemy import ForeignKey
 from sqlalchemy.orm import relationship, backref
@@ -19,9 +19,21 @@ author_books = Table('author_books', Base.metadata,
     Column('book_id', Integer, ForeignKey('books.id')),
     Column('author_id', Integer, ForeignKey('authors.id'))
 )
+# Both directions of many-to-many relations are queried
+Index('ix_book_genres_book', book_genres.c.book_id, book_genres.c.genre_id)
+Index('ix_book_genres_genre', book_genres.c.genre_id, book_genres.c.book_id)
+Index('ix_author_books_book', author_books.c.book_id,
+      author_books.c.author_id)
+Index('ix_author_books_author', author_books.c.author_id,
+      author_books.c.book_id)
 
 class Author(Base):
     __tablename__ = 'authors'
+    __table_args__ = (
+        # Unique index instead of constraint: it may be added
+        # to existing database (see elib.migrate).
+        Index('ix_authors_name', 'lastname', 'firstname', unique=True),
+    )
     
     id = Column(Integer, primary_key=True)
     firstname = Column(String)
@@ -54,6 +66,10 @@ class Author(Base):
 
 class Book(Base):
     __tablename__ = 'books'
+    __table_args__ = (
+        Index('ix_books_title', 'title'),
+        Index('ix_books_lang_title', 'lang', 'title'),
+    )
 
     id = Column(Integer, primary_key=True)
     title = Column(String, nullable=False)
@@ -120,3 +136,57 @@ class Genre(Base):
         else:
             s = "{}".format(self.name)
         return s
+
+
+
+class BookFile(Base):
+    """State of indexed file for incremental indexing."""
+    __tablename__ = 'files'
+
+    id = Column(Integer, primary_key=True)
+    path = Column(String, nullable=False, unique=True)
+    size = Column(Integer, nullable=False)
+    mtime = Column(Float, nullable=False)
+    hash = Column(String(40))
+
+    def __init__(self, path, size, mtime, hash=None):
+        self.path = path
+        self.size = size
+        self.mtime = mtime
+        self.hash = hash
+
+    def __repr__(self):
+        return "<BookFile('{}', {}, {})>".format(self.path,
+                                                self.size,
+                                                self.mtime)
+
+
+class Duplicate(Base):
+    """Book found to be copy of other books by elib.dedup.
+    Books of one group have same content (kind 'content')
+    or same title and authors (kind 'metadata')."""
+    __tablename__ = 'duplicates'
+    __table_args__ = (
+        Index('ix_duplicates_group', 'group_id'),
+        Index('ix_duplicates_book', 'book_id'),
+    )
+
+    id = Column(Integer, primary_key=True)
+    group_id = Column(Integer, nullable=False)
+    book_id = Column(Integer, ForeignKey('books.id'), nullable=False)
+    kind = Column(String(10), nullable=False)
+    # Uncompressed size and SHA-1 of content
+    size = Column(Integer)
+    hash = Column(String(40))
+
+    def __init__(self, group_id, book_id, kind, size=None, hash=None):
+        self.group_id = group_id
+        self.book_id = book_id
+        self.kind = kind
+        self.size = size
+        self.hash = hash
+
+    def __repr__(self):
+        return "<Duplicate({}, {}, '{}')>".format(self.group_id,
+                                                   self.book_id,
+                                                   self.kind)
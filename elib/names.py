@@ -0,0 +1,231 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import re
+import heapq
+import unicodedata
+from math import ceil
+from collections import defaultdict
+
+__doc__ = """Normalization of author names and fuzzy lookup of authors
+by trigrams of their names.
+
+Variants of one name get same key: case, ё/е, punctuation,
+middle names and order of first and last name do not matter.
+
+Example:
+    parse("Толстой Лев Николаевич")   # ('Толстой', 'Лев', 'Николаевич')
+    key("Толстой", "Лев") == key("ТОЛСТОЙ", "Лев Николаевич")
+    index = TrigramIndex().load(session)
+    index.find("толстый лев")          # [(0.8, 12), ...]"""
+
+# Minimal similarity of found names
+THRESHOLD = 0.3
+# Minimal similarity of words of name (Jaccard of trigram sets)
+WORDTHRESHOLD = 0.5
+
+PATRONYMIC = re.compile(r'(вич|вна|ична|оглы|кызы)$')
+SURNAME = re.compile(r'(ов|ев|ин|ын|ский|цкий|ской|ова|ева|ина|ына|'
+                     r'ская|цкая|ых|их|енко|ук|юк)$')
+
+STRESS = re.compile('[\u0300\u0301]')
+
+# Common first names, they tell order of names
+FIRSTNAMES = frozenset("""
+    александр александра алексей анатолий андрей анна антон аркадий
+    борис вадим валентин валентина валерий василий вениамин вера
+    виктор виктория виталий владимир владислав всеволод вячеслав
+    габриэль галина генрих геннадий георгий григорий даниил дарья
+    дмитрий евгений евгения егор екатерина елена иван игорь илья
+    ирина кир кирилл константин лариса лев леонид людмила максим
+    марина мария михаил надежда наталья николай нина олег ольга
+    павел петр роман сергей станислав светлана татьяна федор юлия
+    юрий яков""".split())
+
+def fold(text):
+    """Name for comparing: case folded, ё as е,
+    punctuation (except hyphen) and extra spaces removed."""
+    text = unicodedata.normalize('NFD', (text or '').casefold())
+    # Stress marks are dropped, ё is е
+    text = unicodedata.normalize('NFC', STRESS.sub('', text))
+    text = text.replace('ё', 'е')
+    return ' '.join(re.findall(r'\w+(?:-\w+)*', text))
+
+def initial(word):
+    """True for initial like 'Л.' or 'Л'."""
+    return word.endswith('.') or len(word) == 1
+
+def surname(word):
+    """True if word looks like Russian last name."""
+    return len(word) > 4 and SURNAME.search(word) is not None
+
+def parse(text):
+    """Split full name to tuple (lastname, firstname, middlename),
+    missing first and middle names are None, last name is
+    never None (name of one word is last name). Order of names is detected
+    by comma ('Толстой, Лев'), patronymic, initials and
+    endings of Russian last names, otherwise last name
+    is last word."""
+    if ',' in text:
+        lastname, _, rest = text.partition(',')
+        words = rest.split()
+        return (lastname.strip(), words[0] if words else None,
+                ' '.join(words[1:]) or None)
+    words = text.split()
+    if len(words) < 2:
+        return (words[0] if words else text), None, None
+    folded = [fold(word) for word in words]
+    for i in range(1, len(words)):
+        if not PATRONYMIC.search(folded[i]):
+            continue
+        if i == 1 and len(words) == 2:
+            # Лев Николаевич: single name is last name as for one word
+            return words[0], None, words[1]
+        if i == 1:
+            # Лев Николаевич Толстой
+            return ' '.join(words[2:]), words[0], words[1]
+        # Толстой Лев Николаевич
+        return ' '.join(words[:i - 1]), words[i - 1], words[i]
+    if folded[0] in FIRSTNAMES:
+        lastfirst = False
+    elif folded[-1] in FIRSTNAMES or \
+            initial(words[-1]) and not initial(words[0]):
+        lastfirst = True
+    else:
+        lastfirst = bool(surname(folded[0]) and not surname(folded[-1]))
+    if lastfirst:
+        # Толстой Л. Н., Толстой Лев
+        return words[0], words[1], ' '.join(words[2:]) or None
+    return words[-1], words[0], ' '.join(words[1:-1]) or None
+
+def key(lastname, firstname=None):
+    """Identity of author: folded last name and first word
+    of first name (middle name may be in same field),
+    in any order, so swapped names get same key."""
+    first = fold(firstname).split()
+    return tuple(sorted((fold(lastname), first[0] if first else '')))
+
+def trigrams(text):
+    """Set of trigrams of words of folded text,
+    words are padded with spaces as in PostgreSQL pg_trgm."""
+    grams = set()
+    for word in fold(text).split():
+        word = '  {} '.format(word)
+        grams.update(word[i:i + 3] for i in range(len(word) - 2))
+    return grams
+
+
+class TrigramIndex:
+    """Authors by words of their names in memory, words by
+    their trigrams. Words of query are matched to similar words
+    of names, score of author is mean of best similarities
+    of query words to its words. Authors are read from
+    rarest words of query and most similar words first,
+    lookup stops when rest of them can not be better than
+    found ones, so common names are usually not read."""
+    def __init__(self):
+        # word -> ids of authors
+        self.words = defaultdict(set)
+        # id of author -> words of name
+        self.names = {}
+        # trigram -> words
+        self.postings = defaultdict(set)
+        # word -> trigrams
+        self.grams = {}
+        self.maxid = 0
+
+    def __len__(self):
+        return len(self.names)
+
+    def add(self, id_, lastname, firstname=None):
+        self.remove(id_)
+        words = tuple(fold("{} {}".format(lastname or '',
+                                          firstname or '')).split())
+        self.names[id_] = words
+        for word in words:
+            if word not in self.grams:
+                self.grams[word] = grams = frozenset(trigrams(word))
+                for gram in grams:
+                    self.postings[gram].add(word)
+            self.words[word].add(id_)
+        self.maxid = max(self.maxid, id_)
+
+    def remove(self, id_):
+        for word in self.names.pop(id_, ()):
+            ids = self.words[word]
+            ids.discard(id_)
+            if ids:
+                continue
+            del self.words[word]
+            for gram in self.grams.pop(word):
+                self.postings[gram].discard(word)
+                if not self.postings[gram]:
+                    del self.postings[gram]
+
+    def load(self, session):
+        """Add authors saved after last load. Return self."""
+        from elib.models import Author
+        q = session.query(Author.id, Author.lastname, Author.firstname).\
+                filter(Author.id > self.maxid)
+        for id_, lastname, firstname in q:
+            self.add(id_, lastname, firstname)
+        return self
+
+    def similar(self, word, threshold=WORDTHRESHOLD):
+        """Return dictionary of known words with similarity
+        to word (Jaccard of trigram sets) not less than threshold."""
+        grams = trigrams(word)
+        n = len(grams)
+        if not n:
+            return {}
+        # Similar word has at least threshold * n of trigrams,
+        # so it has one of n - need + 1 rarest of them.
+        need = max(1, ceil(threshold * n))
+        lists = sorted((self.postings.get(g, ()) for g in grams), key=len)
+        found = {}
+        for words in lists[:n - need + 1]:
+            for other in words:
+                if other in found:
+                    continue
+                common = len(grams & self.grams[other])
+                found[other] = common / (n + len(self.grams[other]) - common)
+        return dict((w, s) for w, s in found.items() if s >= threshold)
+
+    def find(self, name, limit=10, threshold=THRESHOLD):
+        """Return list of (similarity, id) of authors with similar
+        name, most similar first."""
+        matches = [self.similar(word) for word in fold(name).split()]
+        m = len(matches)
+        if not m:
+            return []
+        # Rarest words of query first
+        order = sorted(matches, key=lambda words:
+                       sum(len(self.words[w]) for w in words))
+        best = []
+        seen = set()
+        for j, words in enumerate(order):
+            for word, similarity in sorted(words.items(),
+                                           key=lambda x: -x[1]):
+                # Authors which are not found yet are not better
+                bound = (similarity + m - j - 1) / m
+                if bound < threshold or \
+                        len(best) >= limit and bound <= best[0][0]:
+                    break
+                for id_ in self.words[word]:
+                    if len(best) >= limit and bound <= best[0][0]:
+                        break
+                    if id_ in seen:
+                        continue
+                    seen.add(id_)
+                    names = self.names[id_]
+                    score = sum(max(match.get(w, 0) for w in names)
+                                for match in matches) / m
+                    if score < threshold:
+                        continue
+                    # Shorter of equally similar names is better
+                    item = (score, -len(names), -id_)
+                    if len(best) < limit:
+                        heapq.heappush(best, item)
+                    elif item > best[0]:
+                        heapq.heapreplace(best, item)
+        return [(score, -id_) for score, n, id_ in sorted(best,
+                                                          reverse=True)]
@@ -0,0 +1,39 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+from collections import deque
+
+__doc__ = """Ordered map over process pool with bounded queue.
+
+Example:
+    for result in imap(parse, walk(path), jobs=4):
+        save(result)"""
+
+def imap(func, iterable, jobs=1, maxqueue=None, ready=None):
+    """Return results of func for every item in order of iterable.
+    jobs - number of worker processes, 1 runs func in current process;
+    maxqueue - max number of items submitted and not returned yet
+    (by default 4 per worker);
+    ready - function called in current process, it returns result
+    for item (for example from cache) or None if func must be called.
+    func must be picklable (module level function or partial)."""
+    if jobs <= 1:
+        for item in iterable:
+            result = ready(item) if ready else None
+            yield func(item) if result is None else result
+        return
+    from concurrent.futures import ProcessPoolExecutor, Future
+    maxqueue = maxqueue or jobs * 4
+    pending = deque()
+    with ProcessPoolExecutor(jobs) as pool:
+        for item in iterable:
+            result = ready(item) if ready else None
+            if result is None:
+                pending.append(pool.submit(func, item))
+            else:
+                future = Future()
+                future.set_result(result)
+                pending.append(future)
+            if len(pending) >= maxqueue:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
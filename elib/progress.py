@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import os
+import sys
+import json
+import time
+from elib.scanner import scan
+
+__doc__ = """Progress of long walks: files/s, MB/s, errors and ETA,
+reported periodically as text or JSON lines.
+
+Example:
+    files, size = precount(path, ('.fb2', '.fb2.zip', '.epub'))
+    progress = Progress(files, size, interval=5)
+    CrawlerManager(manager, progress=progress).run(path)
+    progress.finish()"""
+
+def precount(path, extensions=None, ignore=None, skip=None):
+    """Count files in path which walk of work will meet:
+    only with extensions if given, directories matching
+    ignore patterns are not walked, files for which
+    skip(filename) is true (done by resumed run) are not counted.
+    Return tuple (files, bytes)."""
+    files = 0
+    size = 0
+    for filename in scan(path, extensions, ignore):
+        if skip is not None and skip(filename):
+            continue
+        try:
+            size += os.stat(filename).st_size
+        except OSError:
+            continue
+        files += 1
+    return files, size
+
+def eta(seconds):
+    if seconds is None:
+        return "?"
+    seconds = int(seconds)
+    return "{}:{:02d}:{:02d}".format(seconds // 3600,
+                                     seconds // 60 % 60, seconds % 60)
+
+
+class Progress:
+    """Counts processed files and reports progress
+    not more often than every interval seconds.
+    total, totalbytes - expected files and bytes (from precount)
+    or None; stream - where to write; jsonlines - write reports
+    as JSON objects, one per line; name - name of job in reports."""
+    def __init__(self, total=None, totalbytes=None, interval=2.0,
+                 stream=None, jsonlines=False, name='files'):
+        self.total = total
+        self.totalbytes = totalbytes
+        self.interval = interval
+        self.stream = stream or sys.stderr
+        self.jsonlines = jsonlines
+        self.name = name
+        self.files = 0
+        self.bytes = 0
+        self.errors = 0
+        self.start = time.monotonic()
+        self.next = self.start + interval
+
+    def add(self, filename=None, size=None, error=False):
+        """Count one processed file. Size is taken from
+        file system if it is not given."""
+        if size is None and filename is not None:
+            try:
+                size = os.path.getsize(filename)
+            except OSError:
+                size = 0
+        self.files += 1
+        self.bytes += size or 0
+        if error:
+            self.errors += 1
+        now = time.monotonic()
+        if now >= self.next:
+            self.next = now + self.interval
+            self.report(now)
+
+    def state(self, now=None):
+        """Dictionary with current progress."""
+        now = now or time.monotonic()
+        elapsed = now - self.start
+        rate = self.files / elapsed if elapsed else None
+        left = None
+        if self.totalbytes and self.bytes and elapsed:
+            # Size predicts time better for files of different sizes
+            left = elapsed * max(0, self.totalbytes - self.bytes) / \
+                   self.bytes
+        elif self.total and rate:
+            left = max(0, self.total - self.files) / rate
+        return {"name": self.name,
+                "files": self.files,
+                "total": self.total,
+                "bytes": self.bytes,
+                "errors": self.errors,
+                "elapsed_s": round(elapsed, 3),
+                "files_per_s": round(rate, 1) if rate else None,
+                "mb_per_s": round(self.bytes / elapsed / 2**20, 2)
+                                if elapsed else None,
+                "eta_s": round(left, 1) if left is not None else None,
+                }
+
+    def report(self, now=None, final=False):
+        state = self.state(now)
+        if self.jsonlines:
+            state["final"] = final
+            line = json.dumps(state)
+        else:
+            line = "{}: {}{}, {} files/s, {} MB/s, errors: {}".format(
+                    state["name"], state["files"],
+                    "/{}".format(self.total) if self.total else "",
+                    state["files_per_s"] or 0, state["mb_per_s"] or 0,
+                    state["errors"])
+            if final:
+                line += ", done in {}".format(eta(state["elapsed_s"]))
+            else:
+                line += ", ETA {}".format(eta(state["eta_s"]))
+        print(line, file=self.stream, flush=True)
+
+    def finish(self):
+        """Report final state."""
+        self.report(final=True)
@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import os
+from fnmatch import fnmatch
+from collections import deque
+
+__doc__ = """Scanner of library directories on os.scandir
+and prefetching of file content ahead of parser.
+
+Example:
+    files = scan(path, ('.fb2', '.epub'), ignore=('.*', '@eaDir'))
+    for filename, data in prefetch(files, buffer=16):
+        parse(filename, data)"""
+
+# Larger files are not prefetched, consumer reads them itself
+MAXSIZE = 64 << 20
+READERS = 4
+
+def ignored(name, ignore):
+    for pattern in ignore:
+        if fnmatch(name, pattern):
+            return True
+    return False
+
+def scan(path, extensions=None, ignore=None, onerror=None):
+    """Yield names of files in path and subdirectories
+    in deterministic order: files of directory sorted by name,
+    then subdirectories sorted by name.
+    extensions - yield only files with these endings;
+    ignore - glob patterns of names of skipped directories;
+    onerror - function called with OSError of unreadable directory.
+    Symbolic links to directories are not followed."""
+    ignore = tuple(ignore or ())
+    stack = [path]
+    while stack:
+        directory = stack.pop()
+        try:
+            with os.scandir(directory) as it:
+                entries = sorted(it, key=lambda entry: entry.name)
+        except OSError as e:
+            if onerror is not None:
+                onerror(e)
+            continue
+        subdirs = []
+        for entry in entries:
+            try:
+                isdir = entry.is_dir(follow_symlinks=False)
+            except OSError:
+                isdir = False
+            if isdir:
+                if not ignored(entry.name, ignore):
+                    subdirs.append(entry.path)
+            elif extensions is None or entry.name.endswith(extensions):
+                yield entry.path
+        stack.extend(reversed(subdirs))
+
+def walkkey(path, filename):
+    """Sort key of filename in order of scan(path):
+    files of directory go before its subdirectories."""
+    parts = os.path.relpath(filename, path).split(os.sep)
+    return tuple((1, name) for name in parts[:-1]) + ((0, parts[-1]),)
+
+def readfile(filename, maxsize=MAXSIZE):
+    """Content of file or None if it is too large or unreadable
+    (consumer opens it again and reports error)."""
+    try:
+        with open(filename, 'rb') as f:
+            if os.fstat(f.fileno()).st_size > maxsize:
+                return None
+            return f.read()
+    except OSError:
+        return None
+
+def prefetch(files, buffer=8, readers=READERS, maxsize=MAXSIZE,
+             wanted=None):
+    """Yield tuples (filename, data) in order of files,
+    content of next buffer files is read by reader threads
+    while current one is processed.
+    wanted - function of filename, False if file must not be read;
+    data is None for files which were not read: larger than maxsize,
+    unreadable or not wanted."""
+    from concurrent.futures import ThreadPoolExecutor, Future
+    skipped = Future()
+    skipped.set_result(None)
+    with ThreadPoolExecutor(max(1, readers)) as executor:
+        queue = deque()
+        for filename in files:
+            if wanted is None or wanted(filename):
+                future = executor.submit(readfile, filename, maxsize)
+            else:
+                future = skipped
+            queue.append((filename, future))
+            if len(queue) > buffer:
+                filename, future = queue.popleft()
+                yield filename, future.result()
+        while queue:
+            filename, future = queue.popleft()
+            yield filename, future.result()
+
+def withdata(func, item, **kwargs):
+    """Call func(filename, data=data, **kwargs) for item
+    (filename, data) of prefetch. Module level function,
+    so it may run in worker process."""
+    filename, data = item
+    return func(filename, data=data, **kwargs)
@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import re
+from sqlalchemy import text
+from sqlalchemy.exc import OperationalError
+
+__doc__ = """Full-text index of book titles and author names
+(SQLite FTS5 virtual table books_fts, rowid is id of book).
+
+Functions take SQLAlchemy connection or session, except
+create and exists, which take engine.
+
+Example:
+    if search.create(engine):
+        search.rebuild(session)
+    ids = search.find(session, "Стругацкий", 10)"""
+
+TABLE = 'books_fts'
+
+def create(bind):
+    """Create full-text table if database supports it.
+    Return True if table exists."""
+    if bind.dialect.name != 'sqlite':
+        return False
+    try:
+        with bind.begin() as connection:
+            connection.execute(text(
+                "CREATE VIRTUAL TABLE IF NOT EXISTS {} "
+                "USING fts5(title, authors)".format(TABLE)))
+    except OperationalError:
+        # SQLite is built without FTS5
+        return False
+    return True
+
+def exists(engine):
+    """True if full-text table is in database."""
+    if engine.dialect.name != 'sqlite':
+        return False
+    with engine.connect() as connection:
+        return connection.execute(text(
+            "SELECT 1 FROM sqlite_master WHERE name = :name"),
+            {"name": TABLE}).first() is not None
+
+def remove(connection, ids):
+    """Remove books from full-text index."""
+    ids = list(ids)
+    for i in range(0, len(ids), 500):
+        part = ids[i:i + 500]
+        connection.execute(text("DELETE FROM {} WHERE rowid IN ({})".\
+                format(TABLE, ",".join(str(int(id_)) for id_ in part))))
+
+def add(connection, rows):
+    """Add books to full-text index.
+    rows - list of dictionaries with id, title and authors."""
+    if rows:
+        connection.execute(text(
+            "INSERT INTO {} (rowid, title, authors) "
+            "VALUES (:id, :title, :authors)".format(TABLE)), rows)
+
+def rebuild(connection):
+    """Fill full-text index from books and authors tables."""
+    connection.execute(text("DELETE FROM {}".format(TABLE)))
+    connection.execute(text(
+        "INSERT INTO {} (rowid, title, authors) "
+        "SELECT b.id, b.title, "
+        "COALESCE(GROUP_CONCAT(TRIM(COALESCE(a.lastname, '') || ' ' || "
+        "COALESCE(a.firstname, '')), ', '), '') "
+        "FROM books b "
+        "LEFT JOIN author_books ab ON ab.book_id = b.id "
+        "LEFT JOIN authors a ON a.id = ab.author_id "
+        "GROUP BY b.id".format(TABLE)))
+
+def authorsline(authors):
+    """Text of authors names for index.
+    authors - list of (lastname, firstname)."""
+    return ", ".join(" ".join(x for x in name if x) for name in authors)
+
+def matchquery(query):
+    """Convert user input to FTS5 query:
+    every word is prefix, all words are required."""
+    words = re.findall(r'\w+', query)
+    return " ".join('"{}"*'.format(word) for word in words)
+
+def find(connection, query, limit=50):
+    """Return ids of best matched books, best first."""
+    query = matchquery(query)
+    if not query:
+        return []
+    rows = connection.execute(text(
+        "SELECT rowid FROM {0} WHERE {0} MATCH :query "
+        "ORDER BY rank LIMIT :limit".format(TABLE)),
+        {"query": query, "limit": limit})
+    return [row[0] for row in rows]
@@ -0,0 +1,404 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import os
+import time
+import struct
+import select
+import logging
+from itertools import groupby
+from collections import OrderedDict
+from elib.scanner import scan, ignored
+
+__doc__ = """Watching of library directory: new, changed, renamed
+and deleted books are indexed within seconds, without full walks.
+Linux inotify is used, on other systems directory is polled.
+
+Example:
+    cm = CrawlerManager(manager, incremental=True)
+    source = changes(path, EXTENSIONS)
+    cm.run(path)
+    watch(cm, source)"""
+
+# Seconds of quiet after last event of file before it is indexed
+DELAY = 1.0
+# Files indexed in one transaction
+BATCHSIZE = 50
+# Seconds between scans of polling source
+POLLINTERVAL = 5.0
+# Seconds to wait for second half of rename
+MOVEWAIT = 0.5
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+IN_CLOEXEC = 0o2000000
+MASK = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | \
+       IN_DELETE | IN_ONLYDIR
+# struct inotify_event without name
+HEADER = struct.Struct('iIII')
+
+def libc():
+    """C library with inotify functions or None."""
+    try:
+        import ctypes
+        import ctypes.util
+        lib = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        lib.inotify_init1
+    except (ImportError, OSError, AttributeError):
+        return None
+    return lib
+
+
+class Inotify:
+    """Source of changes in path on Linux inotify.
+    Every directory is watched, new ones are added
+    when they are created or moved into path.
+    Events are tuples ('changed', filename), ('deleted', path),
+    ('moved', oldpath, newpath) and ('rescan', path)
+    when kernel queue overflows and events are lost."""
+    def __init__(self, path, extensions=None, ignore=None, logger=None,
+                 lib=None):
+        self.path = path
+        self.extensions = extensions
+        self.ignore = tuple(ignore or ())
+        self.logger = logger or logging.getLogger(__name__)
+        self.lib = lib or libc()
+        if self.lib is None:
+            raise OSError("inotify is not available")
+        self.fd = self.lib.inotify_init1(IN_CLOEXEC)
+        if self.fd < 0:
+            self.error(path)
+        # Watch descriptor -> directory
+        self.watches = {}
+        # Cookie -> (path, isdir, time) of first half of rename
+        self.cookies = {}
+        self.addtree(path)
+
+    def error(self, path):
+        import ctypes
+        errno = ctypes.get_errno()
+        raise OSError(errno, os.strerror(errno), path)
+
+    def wanted(self, path):
+        return self.extensions is None or path.endswith(self.extensions)
+
+    def addtree(self, directory, events=None):
+        """Watch directory and its subdirectories.
+        events - list for files found in them (directory moved
+        into path or files written before watch was added)."""
+        stack = [directory]
+        while stack:
+            directory = stack.pop()
+            wd = self.lib.inotify_add_watch(self.fd, os.fsencode(directory),
+                                            MASK)
+            if wd < 0:
+                try:
+                    self.error(directory)
+                except OSError as e:
+                    self.logger.warning(e)
+                continue
+            self.watches[wd] = directory
+            try:
+                with os.scandir(directory) as it:
+                    entries = sorted(it, key=lambda entry: entry.name)
+            except OSError as e:
+                self.logger.warning(e)
+                continue
+            for entry in entries:
+                try:
+                    isdir = entry.is_dir(follow_symlinks=False)
+                except OSError:
+                    isdir = False
+                if isdir:
+                    if not ignored(entry.name, self.ignore):
+                        stack.append(entry.path)
+                elif events is not None and self.wanted(entry.path):
+                    events.append(('changed', entry.path))
+
+    def movewatches(self, old, new):
+        for wd, directory in self.watches.items():
+            if directory == old or directory.startswith(old + os.sep):
+                self.watches[wd] = new + directory[len(old):]
+
+    def removewatches(self, path):
+        for wd, directory in list(self.watches.items()):
+            if directory == path or directory.startswith(path + os.sep):
+                self.lib.inotify_rm_watch(self.fd, wd)
+                del self.watches[wd]
+
+    def read(self, timeout=None):
+        """Wait for changes not more than timeout seconds
+        (None - until they come). Return list of events."""
+        if self.cookies:
+            timeout = MOVEWAIT if timeout is None else \
+                      min(timeout, MOVEWAIT)
+        events = []
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if ready:
+            data = os.read(self.fd, 1 << 16)
+            offset = 0
+            while offset < len(data):
+                wd, mask, cookie, length = HEADER.unpack_from(data, offset)
+                offset += HEADER.size
+                name = os.fsdecode(data[offset:offset + length].\
+                                   rstrip(b'\0'))
+                offset += length
+                self.handle(wd, mask, cookie, name, events)
+        self.expire(events)
+        return events
+
+    def handle(self, wd, mask, cookie, name, events):
+        if mask & IN_Q_OVERFLOW:
+            self.logger.warning("Inotify queue overflow, rescan {}".\
+                                format(self.path))
+            events.append(('rescan', self.path))
+            return
+        directory = self.watches.get(wd)
+        if directory is None:
+            return
+        if mask & IN_IGNORED:
+            del self.watches[wd]
+            return
+        if not name:
+            return
+        path = os.path.join(directory, name)
+        isdir = bool(mask & IN_ISDIR)
+        if isdir and ignored(name, self.ignore):
+            return
+        if mask & IN_MOVED_FROM:
+            self.cookies[cookie] = (path, isdir, time.monotonic())
+        elif mask & IN_MOVED_TO:
+            moved = self.cookies.pop(cookie, None)
+            old = moved[0] if moved else None
+            if isdir:
+                if old is not None:
+                    self.movewatches(old, path)
+                    events.append(('moved', old, path))
+                else:
+                    self.addtree(path, events)
+            elif old is not None and self.wanted(old) and self.wanted(path):
+                events.append(('moved', old, path))
+            else:
+                # Renamed from or to file which is not a book
+                if old is not None and self.wanted(old):
+                    events.append(('deleted', old))
+                if self.wanted(path):
+                    events.append(('changed', path))
+        elif isdir:
+            if mask & IN_CREATE:
+                self.addtree(path, events)
+            elif mask & IN_DELETE:
+                events.append(('deleted', path))
+        elif self.wanted(path):
+            if mask & (IN_CREATE | IN_CLOSE_WRITE):
+                events.append(('changed', path))
+            elif mask & IN_DELETE:
+                events.append(('deleted', path))
+
+    def expire(self, events):
+        """Files moved out of path are deleted."""
+        now = time.monotonic()
+        for cookie, (path, isdir, start) in list(self.cookies.items()):
+            if now - start < MOVEWAIT:
+                continue
+            del self.cookies[cookie]
+            if isdir:
+                self.removewatches(path)
+                events.append(('deleted', path))
+            elif self.wanted(path):
+                events.append(('deleted', path))
+
+    def close(self):
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class Poller:
+    """Source of changes in path made by comparing of
+    file states (inode, size, mtime) every interval seconds.
+    Renamed file is found by its inode. Events are same
+    as of Inotify."""
+    def __init__(self, path, extensions=None, ignore=None, logger=None,
+                 interval=POLLINTERVAL):
+        self.path = path
+        self.extensions = extensions
+        self.ignore = ignore
+        self.logger = logger or logging.getLogger(__name__)
+        self.interval = interval
+        self.states = self.snapshot()
+        self.next = time.monotonic() + interval
+
+    def snapshot(self):
+        """Dictionary filename -> (inode, size, mtime)."""
+        states = {}
+        for name in scan(self.path, self.extensions, self.ignore,
+                         onerror=self.logger.warning):
+            try:
+                st = os.stat(name)
+            except OSError:
+                continue
+            states[name] = (st.st_ino, st.st_size, st.st_mtime)
+        return states
+
+    def read(self, timeout=None):
+        """Wait for next scan not more than timeout seconds.
+        Return list of events."""
+        wait = max(0, self.next - time.monotonic())
+        if timeout is not None and timeout < wait:
+            time.sleep(timeout)
+            return []
+        time.sleep(wait)
+        self.next = time.monotonic() + self.interval
+        old, self.states = self.states, self.snapshot()
+        return diff(old, self.states)
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def diff(old, new):
+    """Events of changes between two snapshots of Poller."""
+    events = []
+    gone = {}
+    for name in old:
+        if name not in new:
+            gone[old[name]] = name
+    for name, state in new.items():
+        if name in old:
+            if old[name] != state:
+                events.append(('changed', name))
+        elif state in gone:
+            events.append(('moved', gone.pop(state), name))
+        else:
+            events.append(('changed', name))
+    events.extend(('deleted', name) for name in gone.values())
+    return events
+
+def changes(path, extensions=None, ignore=None, logger=None, poll=None):
+    """Source of changes in path: Inotify if it is available,
+    Poller with poll seconds interval otherwise or if poll is given."""
+    logger = logger or logging.getLogger(__name__)
+    if poll is None:
+        try:
+            return Inotify(path, extensions, ignore, logger)
+        except OSError as e:
+            logger.warning("{}, directory is polled".format(e))
+    return Poller(path, extensions, ignore, logger, poll or POLLINTERVAL)
+
+
+class Debouncer:
+    """Holds changes and deletions of files until there are no
+    new events of file for delay seconds, so file written
+    in many steps is indexed once. Renames are not delayed."""
+    def __init__(self, delay=DELAY):
+        self.delay = delay
+        # path -> (kind, time of last event)
+        self.pending = OrderedDict()
+
+    def add(self, events, now=None):
+        """Add events from source. Return list of events
+        which must be applied now (renames and rescans)."""
+        now = time.monotonic() if now is None else now
+        immediate = []
+        for event in events:
+            kind, path = event[:2]
+            if kind == 'moved':
+                self.move(path, event[2])
+                immediate.append(event)
+            elif kind == 'rescan':
+                # Rescan finds all changes itself
+                self.pending.clear()
+                immediate.append(event)
+            else:
+                self.pending.pop(path, None)
+                self.pending[path] = (kind, now)
+        return immediate
+
+    def move(self, old, new):
+        """Pending events of renamed file go with it."""
+        for path in list(self.pending):
+            if path == new or path.startswith(new + os.sep):
+                del self.pending[path]
+        for path in list(self.pending):
+            if path == old or path.startswith(old + os.sep):
+                self.pending[new + path[len(old):]] = self.pending.pop(path)
+
+    def ready(self, now=None):
+        """Return list of events quiet for delay seconds
+        in order they came."""
+        now = time.monotonic() if now is None else now
+        events = [(kind, path) for path, (kind, last)
+                  in self.pending.items() if now - last >= self.delay]
+        for kind, path in events:
+            del self.pending[path]
+        return events
+
+    def wait(self, now=None):
+        """Seconds until first pending event is ready or None."""
+        if not self.pending:
+            return None
+        now = time.monotonic() if now is None else now
+        last = min(last for kind, last in self.pending.values())
+        return max(0, last + self.delay - now)
+
+
+def apply(crawler, events, batchsize=BATCHSIZE):
+    """Apply events to index of crawler (CrawlerManager):
+    renames one by one, changed and deleted files in batches.
+    Errors are logged, so watching goes on."""
+    for kind, group in groupby(events, key=lambda event: event[0]):
+        group = list(group)
+        try:
+            if kind == 'moved':
+                for _, old, new in group:
+                    crawler.move(old, new)
+                    crawler.logger.info("Moved {} to {}".format(old, new))
+            elif kind == 'rescan':
+                crawler.run()
+            else:
+                for i in range(0, len(group), batchsize):
+                    paths = [event[1] for event in group[i:i + batchsize]]
+                    if kind == 'changed':
+                        crawler.update(paths)
+                        crawler.logger.info("Indexed {} changed files".\
+                                            format(len(paths)))
+                    else:
+                        crawler.remove(paths)
+                        crawler.logger.info("Removed {} deleted files".\
+                                            format(len(paths)))
+        except Exception as e:
+            crawler.logger.exception(e)
+
+def watch(crawler, source, delay=DELAY, batchsize=BATCHSIZE, timeout=None):
+    """Keep index of crawler (CrawlerManager) up to date with
+    changes from source until interrupted or timeout seconds pass."""
+    debouncer = Debouncer(delay)
+    end = None if timeout is None else time.monotonic() + timeout
+    while True:
+        now = time.monotonic()
+        if end is not None and now >= end:
+            break
+        wait = debouncer.wait(now)
+        if end is not None:
+            wait = end - now if wait is None else min(wait, end - now)
+        apply(crawler, debouncer.add(source.read(wait)), batchsize)
+        apply(crawler, debouncer.ready(), batchsize)
@@ -1,15 +1,27 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 import os
+import zlib
+import shutil
+import sqlite3
+import hashlib
 import zipfile
+import tempfile
 from io import BytesIO
 import xml.etree.ElementTree as ET
 import logging
+from functools import partial
+from elib.pool import imap
+from elib.metrics import timed, filetype
+from elib import scanner
 __doc__ = """Compress all .fb2 files to individual zip archives.
 Also test all zip archives in path.
 Print output only bad files."""
 
 logger = logging.getLogger(__name__)
+CHUNKSIZE = 1 << 16
+# Files tested by testpath
+TESTED = ('.fb2', '.zip', '.epub')
 
 class InvalidZipFile(Exception):
     def __init__(self, filename, error):
@@ -29,7 +41,7 @@ class InvalidZipFile(Exception):
 class ZipReader:
     """
     Class for read zip archive and return
-    bytes array or BytesIO.
+    bytes array, BytesIO or file-like object.
     """
     def __init__(self, filename):
         self.filename = filename
@@ -52,6 +64,13 @@ class ZipReader:
         if not raw:
             data = BytesIO(data)
         return data
+    def open_member(self, filename):
+        """
+        Open file in zip archive for streaming read.
+        Data is decompressed only as far as it is read,
+        so memory does not depend on size of file.
+        """
+        return self.zip.open(filename)
     def testzip(self):
         return self.zip.testzip()
     def close(self):
@@ -76,38 +95,89 @@ def XMLvalidate(xmlfile, quite=False):
         raise InvalidXMLFile(e) from e
     return True
 
-def walk(path):
+def filehash(filename):
+    """SHA-1 of file content."""
+    h = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        for data in iter(lambda: f.read(1 << 20), b''):
+            h.update(data)
+    return h.hexdigest()
+
+def walk(path, ignore=None):
     """
     Walk on path. Return filename.
+    ignore - glob patterns of names of skipped directories.
     """
-    for base, dirs, files in os.walk(path):
-        for fname in files:
-            yield os.path.join(base, fname)
+    return scanner.scan(path, ignore=ignore, onerror=logger.warning)
 
-def ziponefile(filename, zipname=None):
+def ziponefile(filename, zipname=None, removeoriginal=False,
+               validate=None):
     """
     Zip one file to individual zip archive.
     filename - name of unzipped file;
     zipname - name of zip archive (if None, it be filename+'.zip');
+    removeoriginal - delete filename after archive is written;
+    validate - check XML while compressing (by default for .fb2).
+    Archive is written to temporary file and renamed to zipname
+    only when XML is valid and CRC of archive is checked,
+    so interrupted run does not leave broken archives.
+    Raise InvalidXMLFile or InvalidZipFile.
     """
     if not zipname:
         zipname = filename + '.zip'
-    with zipfile.ZipFile(zipname, 'w', 
-                zipfile.ZIP_DEFLATED) as zip:
-        zip.write(filename, os.path.basename(filename))
+    if validate is None:
+        validate = filename.endswith('.fb2')
+    parser = ET.XMLParser() if validate else None
+    # Temporary file must be on the same filesystem for os.replace
+    directory = os.path.dirname(os.path.abspath(zipname))
+    fd, tmpname = tempfile.mkstemp(prefix='.', suffix='.tmp', dir=directory)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            with zipfile.ZipFile(f, 'w', zipfile.ZIP_DEFLATED) as zip:
+                info = zipfile.ZipInfo.from_file(filename,
+                                            os.path.basename(filename))
+                info.compress_type = zipfile.ZIP_DEFLATED
+                with open(filename, 'rb') as src, \
+                        zip.open(info, 'w') as dst:
+                    for data in iter(lambda: src.read(CHUNKSIZE), b''):
+                        if parser is not None:
+                            parser.feed(data)
+                        dst.write(data)
+                if parser is not None:
+                    parser.close()
+            if removeoriginal:
+                # Original is deleted, so archive must reach the disk
+                f.flush()
+                os.fsync(f.fileno())
+        with ZipReader(tmpname) as reader:
+            error = reader.testzip()
+            if error:
+                raise InvalidZipFile(zipname, error)
+        # mkstemp creates private file, archive gets mode of original
+        shutil.copymode(filename, tmpname)
+        os.replace(tmpname, zipname)
+    except ET.ParseError as e:
+        os.remove(tmpname)
+        raise InvalidXMLFile(e) from e
+    except BaseException:
+        os.remove(tmpname)
+        raise
+    if removeoriginal:
+        os.remove(filename)
 
 
-def testfile(filename):
+def checkfile(filename, data=None):
     """
-    Test one file .zip or .fb2
-    Return True if file valid, and False in other situation.
-    Some invalid zip arhives may be open with other utility.
+    Test one file .zip, .epub or .fb2
+    data - content of file if it is already read.
+    Return None if file valid, or error message.
     """
+    source = filename if data is None else BytesIO(data)
     try:
         if filename.endswith('.fb2'):
-            XMLvalidate(filename)
+            XMLvalidate(source)
         elif filename.endswith('.zip'):
-            with ZipReader(filename) as reader:
+            with ZipReader(source) as reader:
                 error = reader.testzip()
                 if error:
                     raise InvalidZipFile(filename, error)
@@ -115,37 +185,303 @@ def testfile(filename):
                     if name.endswith('.fb2'):
                         datafile = reader.read(name)
                         XMLvalidate(datafile)
-        return True
+        elif filename.endswith('.epub'):
+            with ZipReader(source) as reader:
+                error = reader.testzip()
+                if error:
+                    raise InvalidZipFile(filename, error)
+        return None
     except InvalidXMLFile as e:
-        logger.info("Error in {}: {}".format(filename, e))
+        return "Error in {}: {}".format(filename, e)
     except zipfile.BadZipFile as e:
-        logger.info("{}: {} (Need to check manually!)".format(e, filename))
+        return "{}: {} (Need to check manually!)".format(e, filename)
     except InvalidZipFile as e:
-        logger.info(e)
-    return False
+        return str(e)
+    except (zlib.error, RuntimeError, NotImplementedError, OSError) as e:
+        # Corrupted deflate stream, encrypted member,
+        # unsupported compression or unreadable file
+        return "{}: {}".format(e, filename)
 
-def zippath(path, removeoriginal=False):
+def testfile(filename, cache=None):
+    """
+    Test one file .zip, .epub or .fb2
+    cache - TestCache, unchanged file is not tested again.
+    Return True if file valid, and False in other situation.
+    Some invalid zip arhives may be open with other utility.
+    """
+    result = None if cache is None else cache.lookup(filename)
+    if result is None:
+        result = testjob(filename, hashing=cache is not None and
+                         cache.hashing)
+        if cache is not None:
+            cache.save(filename, result[3], *result[4:])
+    error = result[3]
+    if error:
+        logger.info(error)
+    return error is None
+
+
+class Summary:
+    """
+    Result of zippath or testpath.
+    ok, bad, skipped - counts of files;
+    bytes - size of processed files;
+    failures - list of (filename, error) in walk order.
+    """
+    def __init__(self):
+        self.ok = 0
+        self.bad = 0
+        self.skipped = 0
+        self.bytes = 0
+        self.failures = []
+    def add(self, filename, status, size=0, error=None):
+        """Count result of one file, status is 'ok', 'bad' or 'skipped'."""
+        setattr(self, status, getattr(self, status) + 1)
+        self.bytes += size
+        if error:
+            self.failures.append((filename, error))
+    def __repr__(self):
+        return "<Summary(ok={}, bad={}, skipped={}, bytes={})>".\
+                format(self.ok, self.bad, self.skipped, self.bytes)
+    def __str__(self):
+        return "ok: {}, bad: {}, skipped: {}, processed: {} bytes".\
+                format(self.ok, self.bad, self.skipped, self.bytes)
+
+def zipjob(filename, removeoriginal=False):
+    """
+    Zip one .fb2 file in worker process.
+    Return tuple (filename, status, size, error).
+    """
+    if not filename.endswith('.fb2'):
+        return filename, 'skipped', 0, None
+    try:
+        size = os.path.getsize(filename)
+        ziponefile(filename, removeoriginal=removeoriginal)
+    except OSError as e:
+        return filename, 'bad', 0, str(e)
+    except InvalidXMLFile as e:
+        return filename, 'bad', size, "Error in {}: {}".format(filename, e)
+    except InvalidZipFile as e:
+        return filename, 'bad', size, str(e)
+    return filename, 'ok', size, None
+
+def removeduplicate(filename):
+    """Remove valid .fb2 file if it has .zip copy."""
+    zipname = filename + '.zip'
+    if filename.endswith('.fb2') and os.path.exists(zipname):
+        os.remove(filename)
+
+def testjob(filename, removeoriginal=False, data=None, hashing=False):
+    """
+    Test one file in worker process.
+    data - content of file if it is already read;
+    hashing - also compute SHA-1 of content for TestCache.
+    Return tuple (filename, status, size, error),
+    with hashing - (filename, status, size, error, hash).
+    """
+    if not filename.endswith(TESTED):
+        return filename, 'skipped', 0, None
+    try:
+        size = os.path.getsize(filename) if data is None else len(data)
+        hash_ = None
+        if hashing:
+            hash_ = filehash(filename) if data is None else \
+                    hashlib.sha1(data).hexdigest()
+    except OSError as e:
+        return filename, 'bad', 0, str(e)
+    error = checkfile(filename, data)
+    if error:
+        result = filename, 'bad', size, error
+    else:
+        if removeoriginal:
+            removeduplicate(filename)
+        result = filename, 'ok', size, None
+    return result + (hash_,) if hashing else result
+
+
+class TestCache:
+    """
+    Persistent results of testfile in SQLite database.
+    Result is used again while size and mtime of file are same;
+    with hashing - also if only mtime changed, but content is same.
+    Bad files are remembered too and reported without testing.
+    force - do not use saved results, only save new ones.
+    Support with statement.
+    """
+    def __init__(self, filename, hashing=False, force=False):
+        dirname = os.path.dirname(filename)
+        if dirname and not os.path.exists(dirname):
+            os.makedirs(dirname)
+        self.db = sqlite3.connect(filename)
+        self.db.execute("CREATE TABLE IF NOT EXISTS results ("
+                        "path TEXT PRIMARY KEY, size INTEGER, "
+                        "mtime REAL, hash TEXT, error TEXT)")
+        self.hashing = hashing
+        self.force = force
+        # States of files in test: filename -> (stat, hash)
+        self.pending = {}
+        self.count = 0
+    def __enter__(self):
+        return self
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+    def lookup(self, filename):
+        """
+        Return saved result (filename, status, size, error)
+        or None if file must be tested. Hash of file to test
+        is computed by testjob, not here.
+        """
+        try:
+            st = os.stat(filename)
+        except OSError:
+            return None
+        hash_ = None
+        if not self.force:
+            row = self.db.execute("SELECT size, mtime, hash, error "
+                                  "FROM results WHERE path = ?",
+                                  (filename,)).fetchone()
+            if row is not None:
+                size, mtime, oldhash, error = row
+                if (self.hashing and oldhash and size == st.st_size
+                        and mtime != st.st_mtime):
+                    hash_ = filehash(filename)
+                    if hash_ == oldhash:
+                        mtime = st.st_mtime
+                        self.__save(filename, st, hash_, error)
+                if size == st.st_size and mtime == st.st_mtime:
+                    return filename, 'bad' if error else 'ok', size, error
+        self.pending[filename] = (st, hash_)
+        return None
+    def save(self, filename, error, hash_=None):
+        """Save result of tested file, hash_ - hash returned by testjob."""
+        if filename in self.pending:
+            st, known = self.pending.pop(filename)
+            self.__save(filename, st, hash_ or known, error)
+    def __save(self, filename, st, hash_, error):
+        self.db.execute("INSERT OR REPLACE INTO results "
+                        "VALUES (?, ?, ?, ?, ?)",
+                        (filename, st.st_size, st.st_mtime, hash_, error))
+        self.count += 1
+        if self.count % 1000 == 0:
+            self.db.commit()
+    def close(self):
+        if self.db is not None:
+            self.db.commit()
+            self.db.close()
+            self.db = None
+
+
+def runjobs(job, path, removeoriginal=False, jobs=1, cache=None,
+            metrics=None, stage='job', progress=None, ignore=None,
+            prefetch=0):
+    """
+    Run job for every file in path, in jobs worker processes.
+    Failures are logged in walk order.
+    cache - TestCache for results of testjob;
+    metrics - elib.metrics.Metrics, time of job is observed as stage;
+    progress - elib.progress.Progress for reports while walking;
+    ignore - glob patterns of names of skipped directories;
+    prefetch - number of tested files read ahead by reader threads,
+    job gets their content as data keyword.
+    Return Summary.
+    """
+    # Cache results looked up before prefetch, used by ready
+    found = {}
+    def saved(filename):
+        if filename in found:
+            return found.pop(filename)
+        return cache.lookup(filename)
+    ready = None
+    if cache is not None:
+        def ready(item):
+            filename = item[0] if prefetch else item
+            if not filename.endswith(TESTED):
+                return filename, 'skipped', 0, None
+            result = saved(filename)
+            if result and removeoriginal and result[1] == 'ok':
+                removeduplicate(filename)
+            return result
+    summary = Summary()
+    func = partial(job, removeoriginal=removeoriginal)
+    if cache is not None and cache.hashing:
+        # Files are hashed by job in worker process
+        func = partial(func, hashing=True)
+    files = walk(path, ignore)
+    if metrics is not None:
+        files = metrics.timeiter('walk', files)
+    if prefetch:
+        def wanted(filename):
+            if not filename.endswith(TESTED):
+                return False
+            if cache is None:
+                return True
+            found[filename] = cache.lookup(filename)
+            return found[filename] is None
+        files = scanner.prefetch(files, prefetch, wanted=wanted)
+        func = partial(scanner.withdata, func)
+        if metrics is not None:
+            # Time of waiting for reader threads
+            files = metrics.timeiter('read', files)
+    if metrics is not None:
+        # Job is timed where it runs, maybe in worker process
+        func = partial(timed, func)
+        if ready is not None:
+            lookup = ready
+            def ready(filename):
+                result = lookup(filename)
+                return None if result is None else (result, None)
+    for result in imap(func, files, jobs, ready=ready):
+        if metrics is not None:
+            result, seconds = result
+            kind = filetype(result[0])
+            if seconds is None:
+                metrics.count('cached', stage=stage, type=kind)
+            else:
+                metrics.observe(stage, seconds, type=kind)
+            metrics.count('files', stage=stage, type=kind,
+                          status=result[1])
+            metrics.count('bytes', result[2], stage=stage, type=kind)
+        filename, status, size, error = result[:4]
+        if error:
+            logger.info(error)
+        if cache is not None:
+            cache.save(filename, error, *result[4:])
+        summary.add(filename, status, size, error)
+        if progress is not None:
+            progress.add(size=size, error=status == 'bad')
+    return summary
+
+def zippath(path, removeoriginal=False, jobs=1, metrics=None,
+            progress=None, ignore=None):
     """
     Zip all files in path and subdirectories.
-    removeoriginal - delete original .fb2 files in path
+    removeoriginal - delete original .fb2 files in path;
+    jobs - number of worker processes;
+    metrics - Metrics for timings;
+    progress - Progress for reports;
+    ignore - glob patterns of names of skipped directories.
+    Return Summary.
     """
-    for name in walk(path):
-        if not name.endswith('.fb2'):
-            continue
-        ziponefile(name)
-        if removeoriginal and testfile(name):
-            os.remove(name)
+    return runjobs(zipjob, path, removeoriginal, jobs,
+                   metrics=metrics, stage='zip', progress=progress,
+                   ignore=ignore)
 
-def testpath(path, removeoriginal=False):
+def testpath(path, removeoriginal=False, jobs=1, cache=None, metrics=None,
+             progress=None, ignore=None, prefetch=0):
     """
     Test all zip or fb2 files in path and subdirectories.
+    removeoriginal - delete valid .fb2 files which have .zip copy;
+    jobs - number of worker processes;
+    cache - TestCache, unchanged files are not tested again;
+    metrics - Metrics for timings;
+    progress - Progress for reports;
+    ignore - glob patterns of names of skipped directories;
+    prefetch - number of files read ahead of testing.
+    Return Summary.
     """
-    for name in walk(path):
-        flag = testfile(name)
-        if removeoriginal and testfile(name):
-            zipname = name + '.zip'
-            if os.path.exists(zipname):
-                os.remove(name)
+    return runjobs(testjob, path, removeoriginal, jobs, cache,
+                   metrics=metrics, stage='test', progress=progress,
+                   ignore=ignore, prefetch=prefetch)
 
 def main():
     try:
@@ -159,19 +495,36 @@ def main():
         parser.add_argument("-r", "--removeoriginal",
                             help="remove duplicate files in path",
                             action="store_true")
+        parser.add_argument("-j", "--jobs", type=int, default=1,
+                            help="number of worker processes")
+        parser.add_argument("-f", "--force",
+                            help="test all files again, ignore saved results",
+                            action="store_true")
+        parser.add_argument("--hash",
+                            help="detect changed files by content hash",
+                            action="store_true")
         args = parser.parse_args()
         logging.basicConfig(format='%(levelname)s - %(message)s',
                             level=logging.DEBUG)
         if args.test:
             if os.path.isdir(args.path):
-                testpath(args.path, args.removeoriginal)
+                from elib.config import Config
+                with TestCache(Config().getTestCacheName(),
+                               args.hash, args.force) as cache:
+                    logger.info(testpath(args.path, args.removeoriginal,
+                                         args.jobs, cache))
             elif os.path.isfile(args.path):
-                testfile(args.path)
+                from elib.config import Config
+                with TestCache(Config().getTestCacheName(),
+                               args.hash, args.force) as cache:
+                    testfile(args.path, cache)
         else:
             if os.path.isdir(args.path):
-                zippath(args.path, args.removeoriginal)
+                logger.info(zippath(args.path, args.removeoriginal,
+                                    args.jobs))
             elif os.path.isfile(args.path):
-                ziponefile(args.path, args.removeoriginal)
+                ziponefile(args.path,
+                           removeoriginal=args.removeoriginal)
     except KeyboardInterrupt:
         logger.info("Process stopped manually.")
     except ImportError: